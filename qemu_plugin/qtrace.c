@@ -5,7 +5,11 @@
 #include <fcntl.h>
 #include <inttypes.h>
 #include <assert.h>
+#include <limits.h>
+#include <signal.h>
 #include <sys/types.h>
+#include <sys/wait.h>
+#include <sys/mman.h>
 #include <sys/socket.h>
 #include <sys/sendfile.h>
 #include <arpa/inet.h>
@@ -17,56 +21,476 @@
 
 
 QEMU_PLUGIN_EXPORT int qemu_plugin_version = QEMU_PLUGIN_VERSION;
-struct trace trace;
+enum mode mode = mode_trace;
+enum encoding encoding = encoding_raw;
+bool rle = false;
+enum transport transport = transport_socket;
+int num_trace_credits = TRACE_WINDOW;
+struct trace_ring *ring;
+struct trace socket_trace;
+struct trace *trace = &socket_trace;
+struct vcpu_table *vcpu_table;
+struct bb_count **bb_count_table;
+size_t bb_count_table_size;
+size_t num_bb_counts;
+struct bb_count *bb_count_block;
+size_t bb_count_block_used = BB_COUNT_BLOCK_SIZE;
+uint8_t *edge_map;
 sem_t trace_mutex;
+sem_t credit_mutex;
 sem_t ack_mutex;
 sem_t flush_mutex;
 sem_t maps_mutex;
+sem_t counts_mutex;
+sem_t vcpus_mutex;
+sem_t fork_mutex;
+const char *binary_path;
+uint64_t binary_base;
+bool fork_enabled;
+uint64_t fork_offset;
+uint64_t fork_addr;
+bool fork_server_started;
+int fork_fds[FORK_MAX_FDS];
+size_t num_fork_fds;
+bool guest_base_known;
+struct breakpoint *breakpoints;
+size_t num_breakpoints;
+bool syscall_listed[TRACE_MAX_SYSCALLS];
+bool syscall_allowlist;
+bool syscall_drop;
+bool syscall_async;
 
 
-static void unlocked_trace_flush(enum reason reason, struct trace_info info) {
+static void unlocked_trace_encode_deltas(void)
+{
+    static uint8_t encoded[sizeof(trace->bb_addrs)];
+    size_t size = 0;
+    uint64_t i;
+    uint64_t prev = 0;
+    uint64_t value;
+    int64_t delta;
+
+    for (i = 0; i < trace->header.num_addrs; i++) {
+        /* Keep the raw encoding if the varints would not be smaller */
+        if (size + 10 > sizeof(encoded))
+            return;
+
+        delta = trace->bb_addrs[i] - prev;
+        prev = trace->bb_addrs[i];
+        value = ((uint64_t) delta << 1) ^ (uint64_t) (delta >> 63);
+        do {
+            encoded[size++] = (value & 0x7f) | (value > 0x7f ? 0x80 : 0);
+            value >>= 7;
+        } while (value);
+    }
+
+    memcpy(trace->bb_addrs, encoded, size);
+    trace->header.encoding = encoding_delta;
+    trace->header.num_bytes = size;
+}
+
+/*
+ * Every trace sent to the Python side takes a credit, which is returned once
+ * the Python side has consumed it (RESPONSE_CREDIT or RESPONSE_ACK). Only
+ * trace_full and trace_guest_base are sent without waiting for the Python
+ * side, so emulation only stalls on them once TRACE_WINDOW traces are
+ * outstanding; every other reason
+ * still waits for its RESPONSE_ACK, preserving its ordering guarantees.
+ */
+static void unlocked_trace_send(enum reason reason, struct trace_info info,
+                                const void *data, size_t data_size) {
     size_t size;
+    uint64_t doorbell;
+
+    trace->header.reason = reason;
+    trace->header.info = info;
+    trace->header.encoding = encoding_raw;
+    trace->header.num_bytes = trace->header.num_addrs * sizeof(uint64_t);
 
-    trace.header.reason = reason;
-    trace.header.info = info;
+    if (encoding == encoding_delta && reason != trace_counts)
+        unlocked_trace_encode_deltas();
 
-    size = sizeof(trace.header) + (trace.header.num_addrs * sizeof(uint64_t));
-    assert(write(TRACE_FD, &trace, size) == size);
-    sem_wait(&ack_mutex);
+    switch (transport) {
+    case transport_socket:
+        size = sizeof(trace->header) + trace->header.num_bytes;
+        assert(write(TRACE_FD, trace, size) == size);
+        if (data_size)
+            assert(write(TRACE_FD, data, data_size) == data_size);
+        sem_wait(&credit_mutex);
+        break;
+    case transport_ring:
+        doorbell = ring->head;
+        __atomic_store_n(&ring->head, doorbell + 1, __ATOMIC_RELEASE);
+        assert(write(TRACE_FD, &doorbell, sizeof(doorbell)) == sizeof(doorbell));
+        if (data_size)
+            assert(write(TRACE_FD, data, data_size) == data_size);
+        sem_wait(&credit_mutex);
+        trace = &ring->slots[ring->head % ring->num_slots];
+        break;
+    }
+
+    if (reason != trace_full && reason != trace_guest_base)
+        sem_wait(&ack_mutex);
 
-    trace.header.reason = 0;
-    trace.header.num_addrs = 0;
-    trace.header.info = EMPTY_INFO;
+    trace->header.reason = 0;
+    trace->header.num_addrs = 0;
+    trace->header.num_records = 0;
+    trace->header.info = EMPTY_INFO;
+}
+
+static void unlocked_trace_flush(enum reason reason, struct trace_info info) {
+    unlocked_trace_send(reason, info, NULL, 0);
+}
+
+static void unlocked_vcpu_trace_drain(struct vcpu_trace *vcpu)
+{
+    uint64_t head = __atomic_load_n(&vcpu->head, __ATOMIC_ACQUIRE);
+    uint64_t tail = vcpu->tail;
+    uint64_t word;
+    uint64_t length;
+
+    while (tail != head) {
+        word = vcpu->bb_addrs[tail % TRACE_MAX_BB_ADDRS];
+        if (!(word & TRACE_RECORD_FLAG)) {
+            trace->bb_addrs[trace->header.num_addrs++] = word;
+            tail++;
+        } else {
+            /* Records are never split across traces */
+            length = 1 + TRACE_RECORD_LENGTH(word);
+            if (trace->header.num_addrs + length > TRACE_MAX_BB_ADDRS)
+                unlocked_trace_flush(trace_full, EMPTY_INFO);
+            while (length--)
+                trace->bb_addrs[trace->header.num_addrs++] = vcpu->bb_addrs[tail++ % TRACE_MAX_BB_ADDRS];
+            trace->header.num_records++;
+        }
+        if (trace->header.num_addrs == TRACE_MAX_BB_ADDRS)
+            unlocked_trace_flush(trace_full, EMPTY_INFO);
+    }
+
+    __atomic_store_n(&vcpu->tail, tail, __ATOMIC_RELEASE);
+}
+
+static void unlocked_trace_drain(void)
+{
+    unsigned int i;
+    struct vcpu_table *table = __atomic_load_n(&vcpu_table, __ATOMIC_ACQUIRE);
+    struct vcpu_trace *vcpu;
+
+    for (i = 0; table && i < table->size; i++) {
+        vcpu = __atomic_load_n(&table->vcpus[i], __ATOMIC_ACQUIRE);
+        if (vcpu)
+            unlocked_vcpu_trace_drain(vcpu);
+    }
+}
+
+static void unlocked_trace_flush_pending(void)
+{
+    unlocked_trace_drain();
+    if (trace->header.num_addrs)
+        unlocked_trace_flush(trace_full, EMPTY_INFO);
 }
 
 static void trace_flush(enum reason reason, struct trace_info info) {
     sem_wait(&trace_mutex);
+    unlocked_trace_drain();
     unlocked_trace_flush(reason, info);
     sem_post(&trace_mutex);
 }
 
-static void trace_add_bb_addr(uint64_t addr)
+/*
+ * Linux-user gives every guest thread its own cpu_index, so the table of
+ * vcpu traces grows on demand. A grown table replaces the old one, which is
+ * never freed: the drain may still be walking it.
+ */
+static struct vcpu_table *vcpu_table_grow(struct vcpu_table *table,
+                                          unsigned int cpu_index)
 {
-    sem_wait(&trace_mutex);
-    trace.bb_addrs[trace.header.num_addrs++] = addr;
-    if (trace.header.num_addrs == TRACE_MAX_BB_ADDRS)
-        unlocked_trace_flush(trace_full, EMPTY_INFO);
-    sem_post(&trace_mutex);
+    struct vcpu_table *grown;
+    unsigned int size = table ? table->size : TRACE_MIN_VCPUS;
+
+    while (size <= cpu_index)
+        size *= 2;
+    grown = calloc(1, sizeof(*grown) + size * sizeof(grown->vcpus[0]));
+    assert(grown);
+    grown->size = size;
+    if (table)
+        memcpy(grown->vcpus, table->vcpus, table->size * sizeof(table->vcpus[0]));
+    __atomic_store_n(&vcpu_table, grown, __ATOMIC_RELEASE);
+    return grown;
+}
+
+static struct vcpu_trace *vcpu_trace(unsigned int cpu_index)
+{
+    struct vcpu_table *table = __atomic_load_n(&vcpu_table, __ATOMIC_ACQUIRE);
+    struct vcpu_trace *vcpu;
+
+    if (__builtin_expect(table && cpu_index < table->size, 1)) {
+        vcpu = table->vcpus[cpu_index];
+        if (__builtin_expect(vcpu != NULL, 1))
+            return vcpu;
+    }
+
+    sem_wait(&vcpus_mutex);
+    table = vcpu_table;
+    if (!table || cpu_index >= table->size)
+        table = vcpu_table_grow(table, cpu_index);
+    vcpu = calloc(1, sizeof(*vcpu));
+    assert(vcpu);
+    __atomic_store_n(&table->vcpus[cpu_index], vcpu, __ATOMIC_RELEASE);
+    sem_post(&vcpus_mutex);
+    return vcpu;
+}
+
+static void trace_add_bb_addr(unsigned int cpu_index, uint64_t addr)
+{
+    struct vcpu_trace *vcpu = vcpu_trace(cpu_index);
+    uint64_t head = vcpu->head;
+
+    vcpu->bb_addrs[head % TRACE_MAX_BB_ADDRS] = addr;
+    __atomic_store_n(&vcpu->head, ++head, __ATOMIC_RELEASE);
+
+    if (head - __atomic_load_n(&vcpu->tail, __ATOMIC_ACQUIRE) >= TRACE_MAX_BB_ADDRS) {
+        sem_wait(&trace_mutex);
+        unlocked_trace_drain();
+        sem_post(&trace_mutex);
+    }
+}
+
+/*
+ * Makes room for length words, and for the block appended after them, which
+ * trace_add_bb_addr writes before checking whether the ring is full.
+ */
+static void vcpu_trace_reserve(struct vcpu_trace *vcpu, uint64_t length)
+{
+    uint64_t used = vcpu->head - __atomic_load_n(&vcpu->tail, __ATOMIC_ACQUIRE);
+
+    if (TRACE_MAX_BB_ADDRS - used <= length) {
+        sem_wait(&trace_mutex);
+        unlocked_trace_drain();
+        sem_post(&trace_mutex);
+    }
+}
+
+static uint64_t vcpu_trace_history(struct vcpu_trace *vcpu, uint64_t index)
+{
+    return vcpu->history[index % (2 * TRACE_MAX_RUN_PERIOD)];
+}
+
+static void vcpu_trace_end_run(struct vcpu_trace *vcpu)
+{
+    uint64_t period = vcpu->run_period;
+    uint64_t start = vcpu->history_length - period;
+    uint64_t head = vcpu->head;
+    uint64_t addr;
+    uint64_t i;
+
+    if (!period)
+        return;
+
+    vcpu_trace_reserve(vcpu, 2 + period + vcpu->run_position);
+
+    if (vcpu->run_repeats) {
+        vcpu->bb_addrs[head++ % TRACE_MAX_BB_ADDRS] = TRACE_RECORD(record_run, 1 + period);
+        vcpu->bb_addrs[head++ % TRACE_MAX_BB_ADDRS] = vcpu->run_repeats;
+        for (i = 0; i < period; i++)
+            vcpu->bb_addrs[head++ % TRACE_MAX_BB_ADDRS] = vcpu_trace_history(vcpu, start + i);
+    }
+
+    /* The start of an unfinished repetition is appended as is */
+    for (i = 0; i < vcpu->run_position; i++) {
+        addr = vcpu_trace_history(vcpu, start + i);
+        vcpu->bb_addrs[head++ % TRACE_MAX_BB_ADDRS] = addr;
+        vcpu->history[vcpu->history_length++ % (2 * TRACE_MAX_RUN_PERIOD)] = addr;
+    }
+
+    __atomic_store_n(&vcpu->head, head, __ATOMIC_RELEASE);
+
+    vcpu->run_period = 0;
+    vcpu->run_position = 0;
+    vcpu->run_repeats = 0;
+}
+
+static void trace_add_bb_addr_rle(unsigned int cpu_index, uint64_t addr)
+{
+    struct vcpu_trace *vcpu = vcpu_trace(cpu_index);
+    uint64_t length;
+    uint64_t period;
+    uint64_t i;
+
+    if (vcpu->run_period) {
+        length = vcpu->history_length - vcpu->run_period + vcpu->run_position;
+        if (addr == vcpu_trace_history(vcpu, length)) {
+            if (++vcpu->run_position == vcpu->run_period) {
+                vcpu->run_position = 0;
+                vcpu->run_repeats++;
+            }
+            return;
+        }
+        vcpu_trace_end_run(vcpu);
+    }
+
+    vcpu_trace_reserve(vcpu, 1);
+    vcpu->bb_addrs[vcpu->head % TRACE_MAX_BB_ADDRS] = addr;
+    __atomic_store_n(&vcpu->head, vcpu->head + 1, __ATOMIC_RELEASE);
+    vcpu->history[vcpu->history_length++ % (2 * TRACE_MAX_RUN_PERIOD)] = addr;
+
+    length = vcpu->history_length;
+    for (period = 1; period <= TRACE_MAX_RUN_PERIOD && 2 * period <= length; period++) {
+        for (i = 1; i <= period; i++) {
+            if (vcpu_trace_history(vcpu, length - i) !=
+                vcpu_trace_history(vcpu, length - i - period))
+                break;
+        }
+        if (i > period) {
+            vcpu->run_period = period;
+            return;
+        }
+    }
+}
+
+static void trace_add_record(unsigned int cpu_index, enum record_kind kind,
+                             const uint64_t *words, uint64_t length)
+{
+    struct vcpu_trace *vcpu = vcpu_trace(cpu_index);
+    uint64_t head;
+    uint64_t i;
+
+    if (rle)
+        vcpu_trace_end_run(vcpu);
+    vcpu_trace_reserve(vcpu, 1 + length);
+
+    head = vcpu->head;
+    vcpu->bb_addrs[head++ % TRACE_MAX_BB_ADDRS] = TRACE_RECORD(kind, length);
+    for (i = 0; i < length; i++)
+        vcpu->bb_addrs[head++ % TRACE_MAX_BB_ADDRS] = words[i];
+    __atomic_store_n(&vcpu->head, head, __ATOMIC_RELEASE);
 }
 
 static void vcpu_tb_exec(unsigned int cpu_index, void *udata)
 {
     uint64_t addr = (uint64_t) udata;
-    trace_add_bb_addr(addr);
+    trace_add_bb_addr(cpu_index, addr);
 }
 
-static void vcpu_tb_trans(qemu_plugin_id_t id, struct qemu_plugin_tb *tb)
+static void vcpu_tb_exec_rle(unsigned int cpu_index, void *udata)
 {
-    uint64_t addr = qemu_plugin_tb_vaddr(tb);
+    uint64_t addr = (uint64_t) udata;
+    trace_add_bb_addr_rle(cpu_index, addr);
+}
+
+static void vcpu_tb_exec_edge(unsigned int cpu_index, void *udata)
+{
+    uint64_t location = (uint64_t) udata;
+    struct vcpu_trace *vcpu = vcpu_trace(cpu_index);
+
+    edge_map[location ^ vcpu->edge_prev_location]++;
+    vcpu->edge_prev_location = location >> 1;
+}
+
+static uint64_t edge_location(uint64_t addr)
+{
+    return ((addr >> 4) ^ (addr << 8)) & (EDGE_MAP_SIZE - 1);
+}
+
+static size_t bb_count_hash(uint64_t addr)
+{
+    return (addr * 0x9e3779b97f4a7c15) >> 32;
+}
+
+static void bb_count_table_insert(struct bb_count **table, size_t table_size,
+                                  struct bb_count *entry)
+{
+    size_t i;
+
+    for (i = bb_count_hash(entry->addr) & (table_size - 1); table[i];
+         i = (i + 1) & (table_size - 1));
+    table[i] = entry;
+}
+
+static void bb_count_table_grow(void)
+{
+    size_t i;
+    size_t table_size = bb_count_table_size ? bb_count_table_size * 2 : 0x1000;
+    struct bb_count **table = calloc(table_size, sizeof(*table));
+
+    assert(table);
+    for (i = 0; i < bb_count_table_size; i++) {
+        if (bb_count_table[i])
+            bb_count_table_insert(table, table_size, bb_count_table[i]);
+    }
+    free(bb_count_table);
+    bb_count_table = table;
+    bb_count_table_size = table_size;
+}
+
+/*
+ * Counters are never moved once allocated, as translated code increments
+ * them in place; only the table of pointers to them is resized.
+ */
+static struct bb_count *unlocked_bb_count(uint64_t addr)
+{
+    size_t i;
+    struct bb_count *entry;
+
+    if (num_bb_counts * 2 >= bb_count_table_size)
+        bb_count_table_grow();
+
+    for (i = bb_count_hash(addr) & (bb_count_table_size - 1);
+         (entry = bb_count_table[i]);
+         i = (i + 1) & (bb_count_table_size - 1)) {
+        if (entry->addr == addr)
+            return entry;
+    }
+
+    if (bb_count_block_used == BB_COUNT_BLOCK_SIZE) {
+        bb_count_block = calloc(BB_COUNT_BLOCK_SIZE, sizeof(*bb_count_block));
+        assert(bb_count_block);
+        bb_count_block_used = 0;
+    }
+    entry = &bb_count_block[bb_count_block_used++];
+    entry->addr = addr;
+
+    bb_count_table[i] = entry;
+    num_bb_counts++;
+    return entry;
+}
+
+static void trace_flush_counts(void)
+{
+    size_t i;
+    struct bb_count *entry;
 
-    qemu_plugin_register_vcpu_tb_exec_cb(tb, vcpu_tb_exec,
-                                         QEMU_PLUGIN_CB_NO_REGS,
-                                         (void *) addr);
+    sem_wait(&trace_mutex);
+    sem_wait(&counts_mutex);
+
+    /* Counts must not share a trace with filtered syscall records */
+    unlocked_trace_flush_pending();
+
+    for (i = 0; i < bb_count_table_size; i++) {
+        entry = bb_count_table[i];
+        if (!entry)
+            continue;
+        trace->bb_addrs[trace->header.num_addrs++] = entry->addr;
+        trace->bb_addrs[trace->header.num_addrs++] = entry->count;
+        if (trace->header.num_addrs == TRACE_MAX_BB_ADDRS)
+            unlocked_trace_flush(trace_counts, EMPTY_INFO);
+    }
+    if (trace->header.num_addrs)
+        unlocked_trace_flush(trace_counts, EMPTY_INFO);
+
+    sem_post(&counts_mutex);
+    sem_post(&trace_mutex);
+}
+
+/*
+ * Syscalls the Python side did not ask for are not flushed, nor acked.
+ * Unless they are dropped, they are recorded among the basic blocks, as are
+ * all the others with asynchronous syscall events.
+ */
+static bool syscall_filtered(int64_t num)
+{
+    bool listed = num >= 0 && num < TRACE_MAX_SYSCALLS && syscall_listed[num];
+    return listed != syscall_allowlist;
 }
 
 static void vcpu_syscall(qemu_plugin_id_t id, unsigned int vcpu_index,
@@ -75,6 +499,17 @@ static void vcpu_syscall(qemu_plugin_id_t id, unsigned int vcpu_index,
                          uint64_t a6, uint64_t a7, uint64_t a8)
 {
     struct trace_info info;
+    bool filtered;
+
+    filtered = syscall_filtered(num);
+    if (filtered && syscall_drop)
+        return;
+    if (filtered || syscall_async) {
+        trace_add_record(vcpu_index, record_syscall_start,
+                         (uint64_t []) { num, a1, a2, a3, a4, a5, a6, a7, a8 }, 9);
+        return;
+    }
+
     info.syscall_num = num;
     info.syscall_a1 = a1;
     info.syscall_a2 = a2;
@@ -85,6 +520,8 @@ static void vcpu_syscall(qemu_plugin_id_t id, unsigned int vcpu_index,
     info.syscall_a7 = a7;
     info.syscall_a8 = a8;
 
+    if (rle)
+        vcpu_trace_end_run(vcpu_trace(vcpu_index));
     trace_flush(trace_syscall_start, info);
 }
 
@@ -92,29 +529,64 @@ static void vcpu_syscall_ret(qemu_plugin_id_t id, unsigned int vcpu_index,
                              int64_t num, int64_t ret)
 {
     struct trace_info info;
+    bool filtered;
+
+    filtered = syscall_filtered(num);
+    if (filtered && syscall_drop)
+        return;
+    if (filtered || syscall_async) {
+        trace_add_record(vcpu_index, record_syscall_end, (uint64_t []) { num, ret }, 2);
+        return;
+    }
+
     info.syscall_num = num;
     info.syscall_ret = ret;
 
+    if (rle)
+        vcpu_trace_end_run(vcpu_trace(vcpu_index));
     trace_flush(trace_syscall_end, info);
 }
 
 static void *handle_client(void *arg)
 {
     uint64_t response;
+    struct iovec iov = { &response, sizeof(response) };
+    union {
+        struct cmsghdr header;
+        char buffer[CMSG_SPACE(sizeof(fork_fds))];
+    } control;
+    struct msghdr message = {
+        .msg_iov = &iov,
+        .msg_iovlen = 1,
+        .msg_control = &control,
+    };
+    struct cmsghdr *cmsg;
 
     while (true) {
-        assert(read(TRACE_FD, &response, sizeof(response)) == sizeof(response));
+        message.msg_controllen = sizeof(control);
+        assert(recvmsg(TRACE_FD, &message, MSG_WAITALL) == sizeof(response));
 
         switch (response) {
         case RESPONSE_ACK:
+            sem_post(&credit_mutex);
             sem_post(&ack_mutex);
             break;
+        case RESPONSE_CREDIT:
+            sem_post(&credit_mutex);
+            break;
         case REQUEST_FLUSH:
             sem_post(&flush_mutex);
             break;
         case REQUEST_MAPS:
             sem_post(&maps_mutex);
             break;
+        case REQUEST_FORK:
+            cmsg = CMSG_FIRSTHDR(&message);
+            assert(cmsg && cmsg->cmsg_level == SOL_SOCKET && cmsg->cmsg_type == SCM_RIGHTS);
+            num_fork_fds = (cmsg->cmsg_len - CMSG_LEN(0)) / sizeof(int);
+            memcpy(fork_fds, CMSG_DATA(cmsg), num_fork_fds * sizeof(int));
+            sem_post(&fork_mutex);
+            break;
         default:
             assert(false);
             break;
@@ -122,12 +594,33 @@ static void *handle_client(void *arg)
     }
 }
 
+static void trace_flush_breakpoint_hits(void)
+{
+    uint64_t hits[num_breakpoints];
+    struct trace_info info = EMPTY_INFO;
+    size_t i;
+
+    for (i = 0; i < num_breakpoints; i++)
+        hits[i] = __atomic_load_n(&breakpoints[i].hits, __ATOMIC_RELAXED);
+
+    sem_wait(&trace_mutex);
+    unlocked_trace_drain();
+    unlocked_trace_send(trace_breakpoint_hits, info, hits, sizeof(hits));
+    sem_post(&trace_mutex);
+}
+
 static void *handle_flush(void *arg)
 {
     while (true) {
         sem_wait(&flush_mutex);
+        if (mode == mode_count)
+            trace_flush_counts();
+        if (num_breakpoints)
+            trace_flush_breakpoint_hits();
         trace_flush(trace_async, EMPTY_INFO);
     }
+
+    return NULL;
 }
 
 static void *handle_maps(void *arg)
@@ -136,6 +629,7 @@ static void *handle_maps(void *arg)
     int n;
     int count;
     char buffer[0x10000];
+    struct trace_info info = EMPTY_INFO;
 
     while (true) {
         sem_wait(&maps_mutex);
@@ -145,12 +639,397 @@ static void *handle_maps(void *arg)
         for (count = 0; (n = read(maps_fd, buffer + count, 0x10000 - count - 1)) > 0; count += n);
         buffer[count++] = '\n';
         assert(count != 0x10000);
-        write(TRACE_FD, buffer, count);
         close(maps_fd);
 
-        sem_wait(&ack_mutex);
+        info.maps_size = count;
+        unlocked_trace_drain();
+        unlocked_trace_send(trace_maps, info, buffer, count);
         sem_post(&trace_mutex);
     }
+
+    return NULL;
+}
+
+static const char *plugin_arg(int argc, char **argv, const char *name)
+{
+    int i;
+    size_t length = strlen(name);
+
+    for (i = 0; i < argc; i++) {
+        if (!strncmp(argv[i], name, length) && argv[i][length] == '=')
+            return argv[i] + length + 1;
+    }
+    return NULL;
+}
+
+static void ring_install(int ring_fd)
+{
+    struct trace_ring ring_header;
+    size_t size;
+
+    assert(pread(ring_fd, &ring_header, sizeof(ring_header), 0) == sizeof(ring_header));
+    size = sizeof(ring_header) + ring_header.num_slots * sizeof(struct trace);
+
+    ring = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, ring_fd, 0);
+    assert(ring != MAP_FAILED);
+    assert(close(ring_fd) != -1);
+
+    transport = transport_ring;
+    trace = &ring->slots[ring->head % ring->num_slots];
+    num_trace_credits = ring->num_slots - 1;
+}
+
+static void plugin_exit(qemu_plugin_id_t id, void *udata)
+{
+    /*
+     * The exit syscall itself may have been filtered. What is left is acked,
+     * so the Python side has consumed everything before the process exits.
+     */
+    sem_wait(&trace_mutex);
+    unlocked_trace_drain();
+    if (trace->header.num_addrs)
+        unlocked_trace_flush(trace_async, EMPTY_INFO);
+    sem_post(&trace_mutex);
+    if (mode == mode_count)
+        trace_flush_counts();
+    if (num_breakpoints)
+        trace_flush_breakpoint_hits();
+}
+
+static void edges_install(int edges_fd)
+{
+    edge_map = mmap(NULL, EDGE_MAP_SIZE, PROT_READ | PROT_WRITE, MAP_SHARED, edges_fd, 0);
+    assert(edge_map != MAP_FAILED);
+    assert(close(edges_fd) != -1);
+
+    mode = mode_edges;
+}
+
+static void trace_channel_init(void)
+{
+    pthread_t thread;
+
+    sem_init(&trace_mutex, 0, 1);
+    sem_init(&credit_mutex, 0, num_trace_credits);
+    sem_init(&ack_mutex, 0, 0);
+    sem_init(&flush_mutex, 0, 0);
+    sem_init(&maps_mutex, 0, 0);
+    sem_init(&counts_mutex, 0, 1);
+    sem_init(&vcpus_mutex, 0, 1);
+    sem_init(&fork_mutex, 0, 0);
+
+    pthread_create(&thread, NULL, handle_client, NULL);
+    pthread_create(&thread, NULL, handle_flush, NULL);
+    pthread_create(&thread, NULL, handle_maps, NULL);
+}
+
+static uint64_t binary_base_address(const char *path)
+{
+    FILE *maps = fopen("/proc/self/maps", "r");
+    char line[PATH_MAX + 0x100];
+    char pathname[PATH_MAX];
+    uint64_t start;
+    uint64_t offset;
+    uint64_t base = 0;
+
+    assert(maps);
+    while (!base && fgets(line, sizeof(line), maps)) {
+        if (sscanf(line, "%" SCNx64 "-%*x %*s %" SCNx64 " %*s %*s %4095s",
+                   &start, &offset, pathname) == 3 &&
+            offset == 0 && !strcmp(pathname, path))
+            base = start;
+    }
+    fclose(maps);
+
+    assert(base);
+    return base;
+}
+
+/*
+ * Only the forking vCPU thread survives fork(), so the child takes over the
+ * channel it was sent, resets what the parent traced before the fork, and
+ * starts its own helper threads.
+ */
+static void fork_child(void)
+{
+    size_t i;
+    unsigned int cpu_index;
+    struct vcpu_trace *vcpu;
+
+    assert(dup2(fork_fds[0], TRACE_FD) != -1);
+    for (i = 0; i < 3; i++)
+        assert(dup2(fork_fds[1 + i], i) != -1);
+    for (i = 0; i < 4; i++)
+        assert(close(fork_fds[i]) != -1);
+
+    i = 4;
+    if (transport == transport_ring)
+        ring_install(fork_fds[i++]);
+    else
+        trace = &socket_trace;
+    if (mode == mode_edges)
+        edges_install(fork_fds[i++]);
+    assert(i == num_fork_fds);
+
+    for (i = 0; i < bb_count_table_size; i++) {
+        if (bb_count_table[i])
+            bb_count_table[i]->count = 0;
+    }
+
+    for (i = 0; i < num_breakpoints; i++)
+        breakpoints[i].hits = 0;
+
+    for (cpu_index = 0; vcpu_table && cpu_index < vcpu_table->size; cpu_index++) {
+        vcpu = vcpu_table->vcpus[cpu_index];
+        if (vcpu) {
+            vcpu->tail = vcpu->head;
+            vcpu->edge_prev_location = 0;
+        }
+    }
+
+    trace_channel_init();
+}
+
+/*
+ * The first time the fork address is reached, the process becomes a fork
+ * server: it forks a child for every REQUEST_FORK, reports its pid, and
+ * reports its wait status once it exits. Children carry on from the fork
+ * address, sharing everything translated so far.
+ */
+static void vcpu_fork_server(unsigned int cpu_index, void *udata)
+{
+    struct trace_info info = EMPTY_INFO;
+    pid_t pid;
+    int status;
+    size_t i;
+
+    if (fork_server_started)
+        return;
+    fork_server_started = true;
+
+    if (rle)
+        vcpu_trace_end_run(vcpu_trace(cpu_index));
+    trace_flush(trace_fork_server, EMPTY_INFO);
+
+    while (true) {
+        sem_wait(&fork_mutex);
+
+        pid = fork();
+        assert(pid != -1);
+        if (!pid) {
+            fork_child();
+            return;
+        }
+
+        for (i = 0; i < num_fork_fds; i++)
+            assert(close(fork_fds[i]) != -1);
+
+        info.fork_pid = pid;
+        trace_flush(trace_fork, info);
+
+        assert(waitpid(pid, &status, 0) == pid);
+        info.fork_status = status;
+        trace_flush(trace_fork_exit, info);
+    }
+}
+
+/* Evaluates a breakpoint's condition on a register's value */
+static bool breakpoint_condition(const struct breakpoint *breakpoint,
+                                 uint64_t value)
+{
+    switch (breakpoint->op) {
+    case breakpoint_eq:
+        return value == breakpoint->value;
+    case breakpoint_ne:
+        return value != breakpoint->value;
+    case breakpoint_lt:
+        return value < breakpoint->value;
+    case breakpoint_le:
+        return value <= breakpoint->value;
+    case breakpoint_gt:
+        return value > breakpoint->value;
+    case breakpoint_ge:
+        return value >= breakpoint->value;
+    case breakpoint_and:
+        return value & breakpoint->value;
+    }
+    return false;
+}
+
+/*
+ * The plugin API has no access to guest registers, but callbacks are called
+ * straight from translated code, which keeps the guest's CPUX86State in the
+ * frame pointer register of x86_64 hosts. The frame pointer saved by this
+ * callback's prologue therefore points to it, and its first members are the
+ * general purpose registers. As this callback reads registers, TCG stores
+ * them there before calling it, even in the middle of a block.
+ */
+__attribute__((noinline, optimize("no-omit-frame-pointer")))
+static void vcpu_breakpoint(unsigned int cpu_index, void *udata)
+{
+    const uint64_t *env = *(uint64_t **) __builtin_frame_address(0);
+    uint64_t registers[TRACE_NUM_REGISTERS];
+    struct trace_info info = EMPTY_INFO;
+    size_t index = (size_t) udata;
+    struct breakpoint *breakpoint = &breakpoints[index];
+    uint64_t hits = __atomic_add_fetch(&breakpoint->hits, 1, __ATOMIC_RELAXED);
+
+    /* Hits the Python side does not need stay in emulation */
+    if (!breakpoint->every || hits % breakpoint->every)
+        return;
+    if (breakpoint->reg >= 0 && !breakpoint_condition(breakpoint, env[breakpoint->reg]))
+        return;
+
+    memcpy(registers, env, (TRACE_NUM_REGISTERS - 1) * sizeof(uint64_t));
+    registers[TRACE_NUM_REGISTERS - 1] = binary_base + breakpoint->offset;
+    info.breakpoint = index;
+
+    if (rle)
+        vcpu_trace_end_run(vcpu_trace(cpu_index));
+    sem_wait(&trace_mutex);
+    unlocked_trace_drain();
+    unlocked_trace_send(trace_breakpoint, info, registers, sizeof(registers));
+    sem_post(&trace_mutex);
+}
+
+/* Compares breakpoints, or an offset to a breakpoint, by offset */
+static int compare_offsets(const void *a, const void *b)
+{
+    uint64_t offset_a = *(const uint64_t *) a;
+    uint64_t offset_b = ((const struct breakpoint *) b)->offset;
+
+    return (offset_a > offset_b) - (offset_a < offset_b);
+}
+
+/* Parses allow:num:num... or deny:num:num... */
+static void syscall_filter_install(const char *filter)
+{
+    char *end;
+    uint64_t num;
+
+    if (!strncmp(filter, "allow", 5))
+        syscall_allowlist = true;
+    else
+        assert(!strncmp(filter, "deny", 4));
+
+    for (filter = strchr(filter, ':'); filter && filter[1]; filter = strchr(end, ':')) {
+        num = strtoull(filter + 1, &end, 0);
+        assert(end != filter + 1);
+        if (num < TRACE_MAX_SYSCALLS)
+            syscall_listed[num] = true;
+    }
+}
+
+/*
+ * Parses breakpoints separated by ':', each offset[/every[/reg/op/value]],
+ * every defaulting to 1.
+ */
+static void breakpoints_install(const char *specs)
+{
+    const char *c;
+    char *end;
+    struct breakpoint *breakpoint;
+
+    num_breakpoints = 1;
+    for (c = specs; *c; c++)
+        num_breakpoints += *c == ':';
+
+    breakpoints = calloc(num_breakpoints, sizeof(struct breakpoint));
+    assert(breakpoints);
+    for (num_breakpoints = 0; *specs; specs = end + (*end == ':')) {
+        breakpoint = &breakpoints[num_breakpoints++];
+        breakpoint->every = 1;
+        breakpoint->reg = -1;
+
+        breakpoint->offset = strtoull(specs, &end, 0);
+        assert(end != specs);
+        if (*end == '/')
+            breakpoint->every = strtoull(end + 1, &end, 0);
+        if (*end == '/') {
+            breakpoint->reg = strtoll(end + 1, &end, 0);
+            assert(*end == '/' && breakpoint->reg < TRACE_NUM_REGISTERS - 1);
+            breakpoint->op = strtoul(end + 1, &end, 0);
+            assert(*end == '/' && breakpoint->op <= breakpoint_and);
+            breakpoint->value = strtoull(end + 1, &end, 0);
+        }
+        assert(*end == ':' || !*end);
+    }
+    qsort(breakpoints, num_breakpoints, sizeof(struct breakpoint), compare_offsets);
+}
+
+static void vcpu_tb_trans(qemu_plugin_id_t id, struct qemu_plugin_tb *tb)
+{
+    uint64_t addr = qemu_plugin_tb_vaddr(tb);
+    struct qemu_plugin_insn *insn;
+    struct trace_info info = EMPTY_INFO;
+    struct bb_count *entry;
+    uint64_t offset;
+    struct breakpoint *breakpoint;
+    size_t i;
+
+    /*
+     * Guest memory is at a fixed offset in QEMU's own address space, which
+     * the Python side needs to access it directly
+     */
+    if (!guest_base_known) {
+        guest_base_known = true;
+        insn = qemu_plugin_tb_get_insn(tb, 0);
+        info.guest_base = (uint64_t) qemu_plugin_insn_haddr(insn) - qemu_plugin_insn_vaddr(insn);
+        trace_flush(trace_guest_base, info);
+    }
+
+    /* The binary is mapped before its first block is translated */
+    if (binary_path && !binary_base) {
+        binary_base = binary_base_address(binary_path);
+        if (fork_enabled)
+            fork_addr = binary_base + fork_offset;
+    }
+
+    /* Registered first, so the child's trace starts with this block */
+    if (fork_addr && addr == fork_addr)
+        qemu_plugin_register_vcpu_tb_exec_cb(tb, vcpu_fork_server,
+                                             QEMU_PLUGIN_CB_NO_REGS, NULL);
+
+    /*
+     * Like gdb breakpoints, these stop before the block is traced, or
+     * inside a block, before their instruction runs
+     */
+    for (i = 0; num_breakpoints && i < qemu_plugin_tb_n_insns(tb); i++) {
+        insn = qemu_plugin_tb_get_insn(tb, i);
+        offset = qemu_plugin_insn_vaddr(insn) - binary_base;
+        breakpoint = bsearch(&offset, breakpoints, num_breakpoints,
+                             sizeof(struct breakpoint), compare_offsets);
+        if (!breakpoint)
+            continue;
+        if (i == 0)
+            qemu_plugin_register_vcpu_tb_exec_cb(tb, vcpu_breakpoint,
+                                                 QEMU_PLUGIN_CB_R_REGS,
+                                                 (void *) (breakpoint - breakpoints));
+        else
+            qemu_plugin_register_vcpu_insn_exec_cb(insn, vcpu_breakpoint,
+                                                   QEMU_PLUGIN_CB_R_REGS,
+                                                   (void *) (breakpoint - breakpoints));
+    }
+
+    switch (mode) {
+    case mode_trace:
+        qemu_plugin_register_vcpu_tb_exec_cb(tb, rle ? vcpu_tb_exec_rle : vcpu_tb_exec,
+                                             QEMU_PLUGIN_CB_NO_REGS,
+                                             (void *) addr);
+        break;
+    case mode_count:
+        sem_wait(&counts_mutex);
+        entry = unlocked_bb_count(addr);
+        sem_post(&counts_mutex);
+        qemu_plugin_register_vcpu_tb_exec_inline(tb, QEMU_PLUGIN_INLINE_ADD_U64,
+                                                 &entry->count, 1);
+        break;
+    case mode_edges:
+        qemu_plugin_register_vcpu_tb_exec_cb(tb, vcpu_tb_exec_edge,
+                                             QEMU_PLUGIN_CB_NO_REGS,
+                                             (void *) edge_location(addr));
+        break;
+    }
 }
 
 QEMU_PLUGIN_EXPORT
@@ -159,40 +1038,97 @@ int qemu_plugin_install(qemu_plugin_id_t id, const qemu_info_t *info,
 {
     int server_fd;
     int client_fd;
-    int maps_fd;
+    const char *trace_fd;
+    const char *ring_fd;
+    const char *window;
+    const char *encoding_name;
+    const char *rle_name;
+    const char *mode_name;
+    const char *edges_fd;
+    const char *offset;
+    const char *breakpoint_offsets;
+    const char *syscall_filter;
+    const char *syscall_drop_name;
+    const char *syscall_events;
     struct sockaddr_in server_addr;
-    pthread_t client_thread;
-    pthread_t flush_thread;
-    uint64_t response;
 
     setvbuf(stdout, NULL, _IONBF, 0);
     setvbuf(stderr, NULL, _IONBF, 0);
 
-    server_fd = socket(AF_INET, SOCK_STREAM, 0);
-    setsockopt(server_fd, SOL_SOCKET, SO_REUSEADDR | SO_REUSEPORT, &(int){1}, sizeof(int));
-    server_addr.sin_family = AF_INET;
-    server_addr.sin_addr.s_addr = INADDR_ANY;
-    server_addr.sin_port = htons(4242);
-    bind(server_fd, (struct sockaddr *) &server_addr, sizeof(server_addr));
-    listen(server_fd, 1);
-    client_fd = accept(server_fd, NULL, NULL);
+    trace_fd = plugin_arg(argc, argv, "trace_fd");
+    if (trace_fd) {
+        client_fd = atoi(trace_fd);
+    } else {
+        server_fd = socket(AF_INET, SOCK_STREAM, 0);
+        setsockopt(server_fd, SOL_SOCKET, SO_REUSEADDR | SO_REUSEPORT, &(int){1}, sizeof(int));
+        server_addr.sin_family = AF_INET;
+        server_addr.sin_addr.s_addr = INADDR_ANY;
+        server_addr.sin_port = htons(4242);
+        bind(server_fd, (struct sockaddr *) &server_addr, sizeof(server_addr));
+        listen(server_fd, 1);
+        client_fd = accept(server_fd, NULL, NULL);
+        assert(close(server_fd) != -1);
+    }
+
+    if (client_fd != TRACE_FD) {
+        assert(dup2(client_fd, TRACE_FD) != -1);
+        assert(close(client_fd) != -1);
+    }
+
+    mode_name = plugin_arg(argc, argv, "mode");
+    if (mode_name && !strcmp(mode_name, "count"))
+        mode = mode_count;
+
+    edges_fd = plugin_arg(argc, argv, "edges_fd");
+    if (edges_fd)
+        edges_install(atoi(edges_fd));
+
+    encoding_name = plugin_arg(argc, argv, "encoding");
+    if (encoding_name && !strcmp(encoding_name, "delta"))
+        encoding = encoding_delta;
+
+    rle_name = plugin_arg(argc, argv, "rle");
+    if (rle_name && !strcmp(rle_name, "on"))
+        rle = true;
+
+    window = plugin_arg(argc, argv, "window");
+    if (window)
+        num_trace_credits = atoi(window);
+
+    ring_fd = plugin_arg(argc, argv, "ring_fd");
+    if (ring_fd)
+        ring_install(atoi(ring_fd));
+
+    /* Fork and breakpoint offsets are relative to where binary_path is loaded */
+    binary_path = plugin_arg(argc, argv, "binary_path");
+    offset = plugin_arg(argc, argv, "fork_offset");
+    if (offset) {
+        fork_enabled = true;
+        fork_offset = strtoull(offset, NULL, 0);
+    }
 
-    assert(dup2(client_fd, TRACE_FD) != -1);
-    assert(close(client_fd) != -1);
-    assert(close(server_fd) != -1);
+    syscall_filter = plugin_arg(argc, argv, "syscall_filter");
+    if (syscall_filter)
+        syscall_filter_install(syscall_filter);
+
+    syscall_drop_name = plugin_arg(argc, argv, "syscall_drop");
+    if (syscall_drop_name && !strcmp(syscall_drop_name, "on"))
+        syscall_drop = true;
+
+    syscall_events = plugin_arg(argc, argv, "syscall_events");
+    if (syscall_events && !strcmp(syscall_events, "async"))
+        syscall_async = true;
+
+    breakpoint_offsets = plugin_arg(argc, argv, "breakpoints");
+    if (breakpoint_offsets && *breakpoint_offsets)
+        breakpoints_install(breakpoint_offsets);
 
     qemu_plugin_register_vcpu_tb_trans_cb(id, vcpu_tb_trans);
     qemu_plugin_register_vcpu_syscall_cb(id, vcpu_syscall);
     qemu_plugin_register_vcpu_syscall_ret_cb(id, vcpu_syscall_ret);
+    qemu_plugin_register_atexit_cb(id, plugin_exit, NULL);
 
-    sem_init(&trace_mutex, 0, 1);
-    sem_init(&ack_mutex, 0, 0);
-    sem_init(&flush_mutex, 0, 0);
-    sem_init(&maps_mutex, 0, 0);
-
-    pthread_create(&client_thread, NULL, handle_client, NULL);
-    pthread_create(&flush_thread, NULL, handle_flush, NULL);
-    pthread_create(&flush_thread, NULL, handle_maps, NULL);
+    trace_channel_init();
 
     return 0;
 }
@@ -2,13 +2,41 @@
 #define QTRACE_H
 
 #define TRACE_MAX_BB_ADDRS  0x1000
+#define TRACE_MIN_VCPUS     0x100
+#define TRACE_WINDOW        8
+#define TRACE_MAX_RUN_PERIOD 8
 #define TRACE_FD            255
+#define TRACE_MAX_SYSCALLS  0x200
+
+enum mode {
+    mode_trace = 0,
+    mode_count = 1,
+    mode_edges = 2,
+};
+
+enum encoding {
+    encoding_raw = 0,
+    encoding_delta = 1,
+};
+
+enum transport {
+    transport_socket = 0,
+    transport_ring = 1,
+};
 
 enum reason {
     trace_full = 0,
     trace_syscall_start = 1,
     trace_syscall_end = 2,
     trace_async = 3,
+    trace_maps = 4,
+    trace_counts = 5,
+    trace_fork_server = 6,
+    trace_fork = 7,
+    trace_fork_exit = 8,
+    trace_guest_base = 9,
+    trace_breakpoint = 10,
+    trace_breakpoint_hits = 11,
 };
 
 struct trace_info {
@@ -25,22 +53,163 @@ struct trace_info {
             uint64_t syscall_a8;
         };
         int64_t syscall_ret;
+        uint64_t maps_size;
+        int64_t fork_pid;
+        int64_t fork_status;
+        uint64_t guest_base;
+        uint64_t breakpoint;
     };
 };
 
 #define EMPTY_INFO (const struct trace_info) { 0 }
 
+/*
+ * A trace_breakpoint is followed by the guest's general purpose registers,
+ * in CPUX86State order (rax, rcx, rdx, rbx, rsp, rbp, rsi, rdi, r8-r15),
+ * and rip.
+ */
+#define TRACE_NUM_REGISTERS 17
+
+enum breakpoint_op {
+    breakpoint_eq = 0,
+    breakpoint_ne = 1,
+    breakpoint_lt = 2,
+    breakpoint_le = 3,
+    breakpoint_gt = 4,
+    breakpoint_ge = 5,
+    breakpoint_and = 6,
+};
+
+/*
+ * A breakpoint at offset from the binary's base. Every hit is counted, but
+ * the Python side is only stopped at every Nth hit where register op value
+ * holds (compared unsigned), and never when every is 0. Without a
+ * condition, reg is -1. Hit counts are sent in trace_breakpoint_hits
+ * traces, one word per breakpoint, on exit and on REQUEST_FLUSH.
+ */
+struct breakpoint {
+    uint64_t offset;
+    uint64_t every;
+    int64_t reg;
+    enum breakpoint_op op;
+    uint64_t value;
+    uint64_t hits;
+};
+
+/*
+ * A word of bb_addrs with TRACE_RECORD_FLAG set, which is never set in a
+ * user space address, starts a record made of that word and the
+ * TRACE_RECORD_LENGTH(word) words following it.
+ */
+#define TRACE_RECORD_FLAG (1ULL << 63)
+#define TRACE_RECORD(kind, length) \
+    (TRACE_RECORD_FLAG | ((uint64_t) (kind) << 32) | (length))
+#define TRACE_RECORD_LENGTH(word) ((word) & 0xffffffff)
+
+enum record_kind {
+    /* repeats, addresses...: addresses executed repeats more times in a row */
+    record_run = 0,
+    /*
+     * num, a1...a8: a syscall that is neither flushed nor acked, because it
+     * is filtered or syscall events are asynchronous
+     */
+    record_syscall_start = 1,
+    /* num, ret */
+    record_syscall_end = 2,
+};
+
+/*
+ * With encoding_delta, bb_addrs holds num_bytes of zigzag LEB128 varints,
+ * each the difference from the previous address (starting from 0), rather
+ * than num_addrs raw addresses.
+ */
 struct trace {
     struct {
         enum reason reason;
+        enum encoding encoding;
         uint64_t num_addrs;
+        uint64_t num_bytes;
+        uint64_t num_records;
         struct trace_info info;
     } header;
     uint64_t bb_addrs[TRACE_MAX_BB_ADDRS];
 };
 
+/*
+ * Per-vCPU single-producer/single-consumer ring of executed basic blocks.
+ * Only the owning vCPU advances head, so appending needs no lock; tail is
+ * only advanced while holding trace_mutex, when the addresses are moved
+ * into the outgoing trace.
+ *
+ * When run-length collapsing is enabled, the owning vCPU also keeps its most
+ * recent addresses in history. Once the last run_period addresses repeat the
+ * run_period before them, further repetitions are only counted, and are
+ * appended as a single record_run once the run ends.
+ *
+ * In edges mode, edge_prev_location is the shifted location of the block the
+ * vCPU executed last.
+ */
+struct vcpu_trace {
+    uint64_t head;
+    uint64_t tail;
+    uint64_t bb_addrs[TRACE_MAX_BB_ADDRS];
+    uint64_t history[2 * TRACE_MAX_RUN_PERIOD];
+    uint64_t history_length;
+    uint64_t run_period;
+    uint64_t run_position;
+    uint64_t run_repeats;
+    uint64_t edge_prev_location;
+};
+
+/* vcpus[cpu_index] is NULL until that vCPU executes its first block. */
+struct vcpu_table {
+    unsigned int size;
+    struct vcpu_trace *vcpus[];
+};
+
+/*
+ * Execution count of the basic block at addr, incremented inline by the
+ * translated code. Sent to the Python side as (addr, count) pairs in the
+ * bb_addrs of trace_counts traces.
+ */
+struct bb_count {
+    uint64_t addr;
+    uint64_t count;
+};
+
+#define BB_COUNT_BLOCK_SIZE 0x1000
+
+/*
+ * AFL-style edge coverage: hit counts of hashed (previous block, current
+ * block) pairs, kept in a shared memory map of EDGE_MAP_SIZE bytes.
+ */
+#define EDGE_MAP_SIZE 0x10000
+
+/*
+ * Shared memory ring of trace slots, mapped by both the plugin and the
+ * Python side. The plugin fills slots[head % num_slots] in place and then
+ * publishes it by advancing head and writing the slot's sequence number to
+ * TRACE_FD as a doorbell. The Python side consumes slots[tail % num_slots] and advances
+ * tail once it no longer needs the slot.
+ */
+struct trace_ring {
+    uint64_t head;
+    uint64_t tail;
+    uint64_t num_slots;
+    struct trace slots[];
+};
+
 #define RESPONSE_ACK 0
 #define REQUEST_FLUSH 1
 #define REQUEST_MAPS 2
+#define RESPONSE_CREDIT 3
+#define REQUEST_FORK 4
+
+/*
+ * A REQUEST_FORK carries the file descriptors of the child's channel:
+ * its trace socket, stdin, stdout and stderr, followed by its ring with
+ * transport_ring and its edge map with mode_edges.
+ */
+#define FORK_MAX_FDS 6
 
 #endif
@@ -8,5 +8,10 @@ QTRACE_PATH = DEPS_PATH / "libqtrace.so"
 
 from .utils import create_connection
 from .syscalls import syscalls, syscall_description
-from .gdb import gdb_minimal_client, breakpoint
+from .gdb import gdb_minimal_client, gdb_rsp_client, breakpoint
+from .coverage import EDGE_MAP_SIZE, EdgeBitmap, Coverage
+from .trace import Trace
+from .tracefile import TraceWriter, TraceFile
 from .machine import TraceMachine, LogTraceMachine
+from .async_machine import AsyncTraceMachine
+from .forkserver import ForkServer
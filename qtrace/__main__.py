@@ -1,9 +1,12 @@
 import sys
 import os
+import json
 import time
 import pathlib
+import argparse
 
 from . import LogTraceMachine
+from .farm import Job, TraceFarm
 
 
 def resolve(path):
@@ -17,11 +20,63 @@ def resolve(path):
                 return current_path
 
 
+def batch(args):
+    parser = argparse.ArgumentParser(
+        prog="qtrace batch", description="Trace many jobs in parallel"
+    )
+    parser.add_argument(
+        "jobs",
+        type=argparse.FileType("r"),
+        help='JSON lines of {"argv": [...], "stdin": "..."} or argv lists, - for stdin',
+    )
+    parser.add_argument("--workers", type=int, help="defaults to the number of cores")
+    parser.add_argument("--timeout", type=float, help="per job, in seconds")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--mode", choices=["trace", "count", "edges"], default="trace")
+    parser.add_argument("--trace-dir", type=pathlib.Path)
+    args = parser.parse_args(args)
+
+    jobs = []
+    for index, line in enumerate(filter(str.strip, args.jobs)):
+        job = json.loads(line)
+        if isinstance(job, list):
+            job = {"argv": job}
+        argv = list(job["argv"])
+        argv[0] = resolve(argv[0]) or argv[0]
+        stdin = job.get("stdin")
+        trace_path = None
+        if args.trace_dir is not None:
+            args.trace_dir.mkdir(parents=True, exist_ok=True)
+            trace_path = args.trace_dir / f"{index}.qtrace"
+        jobs.append(
+            Job(
+                argv,
+                stdin.encode() if stdin is not None else None,
+                job.get("mode", args.mode),
+                trace_path,
+            )
+        )
+
+    farm = TraceFarm(num_workers=args.workers, timeout=args.timeout, retries=args.retries)
+    for job, result in farm.run(jobs):
+        result.pop("edge_bitmap", None)
+        print(json.dumps(result), flush=True)
+
+    stats = dict(farm.stats)
+    stats.update(farm.throughput)
+    if args.mode == "edges":
+        stats["edges"] = farm.coverage.num_edges
+    print(json.dumps(stats), file=sys.stderr)
+
+
 def main():
     args = sys.argv[1:]
     if not args:
         print("Must specify program to trace!", file=sys.stderr)
         exit(1)
+    if args[0] == "batch":
+        batch(args[1:])
+        return
     arg_0 = resolve(args[0])
     if not arg_0:
         print(f"No such file: {args[0]}", file=sys.stderr)
@@ -35,7 +90,7 @@ def main():
     machine.run()
 
     def total(filter_):
-        return len(list(machine.filtered_trace(filter_)))
+        return machine.trace.num_events(filter_)
 
     def unique(filter_):
         return len(set(machine.filtered_trace(filter_)))
@@ -0,0 +1,224 @@
+import os
+import fcntl
+import array
+import socket
+import asyncio
+import inspect
+import termios
+
+from .machine import TRACE_HEADER_STRUCT, TRACE_REASON, TraceHeader, TraceMachine
+
+
+class AsyncTraceMachine(TraceMachine):
+    # Drives the same protocol as TraceMachine, but from the running event
+    # loop's readers instead of a blocking select loop. Breakpoint callbacks
+    # may be coroutine functions; the target stays stopped until they return.
+    # Traces are only handled once they are fully received, so the event loop
+    # never blocks on the trace socket.
+    def __init__(self, argv, **kwargs):
+        super().__init__(argv, **kwargs)
+        self.finished = None
+        self._readers = set()
+        self._stop_task = None
+        self._event_waiters = []
+        self._flush_waiter = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.finished = loop.create_future()
+
+        try:
+            # Startup connects and talks to the target synchronously
+            await loop.run_in_executor(None, self.setup)
+
+            stdin, stdout, stderr = self.std_streams
+            self.add_reader(self.trace_socket, self.on_trace_readable)
+            if self.gdb is not None:
+                self.add_reader(self.gdb.socket, self.on_gdb_readable)
+            self.add_reader(stdout, self.on_output_readable, stdout, 1)
+            self.add_reader(stderr, self.on_output_readable, stderr, 2)
+            if self.trace_buffered():
+                self.on_trace_readable()
+
+            await self.finished
+        except BaseException:
+            self.kill()
+            raise
+        finally:
+            if self._stop_task is not None:
+                self._stop_task.cancel()
+            for stream in list(self._readers):
+                self.remove_reader(stream)
+            self.trace_updated()
+
+        self.finish()
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def add_reader(self, stream, callback, *args):
+        asyncio.get_running_loop().add_reader(stream, callback, *args)
+        self._readers.add(stream)
+
+    def remove_reader(self, stream):
+        asyncio.get_running_loop().remove_reader(stream)
+        self._readers.discard(stream)
+        if not self._readers and not self.finished.done():
+            self.finished.set_result(None)
+
+    def fail(self, exception):
+        if not self.finished.done():
+            self.finished.set_exception(exception)
+
+    def on_trace_readable(self):
+        try:
+            connected = self.trace_fill()
+            while self.trace_complete():
+                reason = self.handle_trace()
+                if reason == TRACE_REASON.trace_async and self._flush_waiter:
+                    self._flush_waiter.set_result(None)
+                    self._flush_waiter = None
+            self.flush_credits()
+            if not connected:
+                self.remove_reader(self.trace_socket)
+        except Exception as e:
+            self.fail(e)
+        self.trace_updated()
+
+    def trace_fill(self):
+        # Reads whatever the trace socket has queued without blocking,
+        # returning False once the plugin closed it
+        buffer = self.trace_buffer
+        start = self.trace_buffer_start
+        end = self.trace_buffer_end
+        buffer[: end - start] = buffer[start:end]
+        self.trace_buffer_start, self.trace_buffer_end = 0, end - start
+
+        try:
+            num_bytes = self.trace_socket.recv_into(
+                buffer[self.trace_buffer_end :], 0, socket.MSG_DONTWAIT
+            )
+        except BlockingIOError:
+            return True
+        self.trace_buffer_end += num_bytes
+        return num_bytes != 0
+
+    def trace_complete(self):
+        # Whether the next trace, and the data following it, is buffered
+        num_buffered = self.trace_buffer_end - self.trace_buffer_start
+        if self.trace_ring is None:
+            size = TRACE_HEADER_STRUCT.size
+            if num_buffered < size:
+                return False
+            trace_header = TraceHeader.unpack_from(
+                self.trace_buffer, self.trace_buffer_start
+            )
+            size += trace_header.num_bytes
+        else:
+            # The slot is written before its doorbell
+            size = 8
+            if num_buffered < size:
+                return False
+            trace_header = TraceHeader.unpack_from(
+                self.trace_ring, self.trace_ring_slot()
+            )
+        return num_buffered >= size + self.trace_data_size(trace_header)
+
+    async def flush(self):
+        # Like request_flush, but the trace is received by on_trace_readable
+        self._flush_waiter = asyncio.get_running_loop().create_future()
+        os.write(self.trace_socket.fileno(), (1).to_bytes(8, "little"))
+        await self._flush_waiter
+
+    def on_output_readable(self, stream, fd):
+        num_bytes = array.array("i", [0])
+        fcntl.ioctl(stream.fileno(), termios.FIONREAD, num_bytes)
+        data = os.read(stream.fileno(), num_bytes[0])
+        self.on_output(fd, data)
+        if not data:
+            self.remove_reader(stream)
+        self.trace_updated()
+
+    def on_gdb_readable(self):
+        # Stop handling may await a callback, so stop watching the socket
+        # until the target is resumed
+        asyncio.get_running_loop().remove_reader(self.gdb.socket)
+        self._stop_task = asyncio.ensure_future(self.handle_gdb_stop())
+
+    async def handle_gdb_stop(self):
+        try:
+            callback = self.gdb.recv_stop()
+            if callback is None:
+                self.remove_reader(self.gdb.socket)
+                return
+            result = callback()
+            if inspect.isawaitable(result):
+                await result
+            self.gdb.resume()
+        except Exception as e:
+            self.fail(e)
+            return
+        finally:
+            self._stop_task = None
+
+        asyncio.get_running_loop().add_reader(self.gdb.socket, self.on_gdb_readable)
+        # Resuming may have read the next stop ahead
+        if self.gdb.buffered():
+            self.on_gdb_readable()
+
+    def handle_breakpoint(self, index, registers):
+        # The target sends nothing more until the ack, so an awaited callback
+        # acks from its own task
+        self.registers = registers
+        try:
+            result = self._breakpoint_callbacks[index]()
+        except BaseException:
+            self.registers = None
+            raise
+        if not inspect.isawaitable(result):
+            self.registers = None
+            self.ack()
+            return
+        self._stop_task = asyncio.ensure_future(self.finish_breakpoint(result))
+
+    async def finish_breakpoint(self, result):
+        try:
+            await result
+            self.ack()
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.registers = None
+            self._stop_task = None
+
+    def breakpoint_callback(self, callback):
+        async def flush_callback():
+            await self.flush()
+            if self.breakpoint_fires(callback):
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+            self._skip_breakpoint_trace_address = True
+
+        return flush_callback
+
+    def trace_updated(self):
+        for waiter in self._event_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._event_waiters.clear()
+
+    async def events(self):
+        # Yields events as they are added to the trace, until the run ends
+        position = 0
+        while True:
+            while position < len(self.trace):
+                yield self.trace[position]
+                position += 1
+            if self.finished is not None and self.finished.done():
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._event_waiters.append(waiter)
+            await waiter
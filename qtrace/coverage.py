@@ -0,0 +1,88 @@
+EDGE_MAP_SIZE = 0x10000
+
+
+def count_class(count):
+    # AFL hit count buckets: each bucket is a single bit, so bucketed maps can
+    # be merged with a bitwise or.
+    if count <= 2:
+        return count
+    if count == 3:
+        return 4
+    for bound, bucket in [(8, 8), (16, 16), (32, 32), (128, 64)]:
+        if count < bound:
+            return bucket
+    return 128
+
+
+COUNT_CLASS_LOOKUP = bytes(count_class(count) for count in range(0x100))
+NONZERO_LOOKUP = bytes([0x00] + [0xFF] * 0xFF)
+
+NO_NEW_COVERAGE = 0
+NEW_HIT_COUNTS = 1
+NEW_EDGES = 2
+
+
+class EdgeBitmap:
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __bytes__(self):
+        return bytes(self.buffer)
+
+    @property
+    def num_edges(self):
+        return len(self.buffer) - bytes(self.buffer).count(0)
+
+    def classify(self):
+        return bytes(self.buffer).translate(COUNT_CLASS_LOOKUP)
+
+    def numpy(self):
+        import numpy
+
+        return numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+
+
+class Coverage:
+    def __init__(self, size=EDGE_MAP_SIZE):
+        self.size = size
+        self.bits = 0
+
+    def __bytes__(self):
+        return self.bits.to_bytes(self.size, "little")
+
+    @property
+    def num_edges(self):
+        return self.size - bytes(self).count(0)
+
+    def new_coverage(self, bitmap):
+        return self._new_coverage(int.from_bytes(bitmap.classify(), "little"))
+
+    def _new_coverage(self, bits):
+        new_bits = bits & ~self.bits
+        if not new_bits:
+            return NO_NEW_COVERAGE
+        seen_edges = int.from_bytes(bytes(self).translate(NONZERO_LOOKUP), "little")
+        if new_bits & ~seen_edges:
+            return NEW_EDGES
+        return NEW_HIT_COUNTS
+
+    def update(self, bitmap):
+        bits = int.from_bytes(bitmap.classify(), "little")
+        result = self._new_coverage(bits)
+        self.bits |= bits
+        return result
+
+    def numpy(self):
+        import numpy
+
+        return numpy.frombuffer(bytes(self), dtype=numpy.uint8)
+
+
+def merge(bitmaps, *, size=EDGE_MAP_SIZE):
+    coverage = Coverage(size)
+    for bitmap in bitmaps:
+        coverage.update(bitmap)
+    return coverage
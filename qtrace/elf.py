@@ -0,0 +1,68 @@
+import struct
+
+
+ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+PROGRAM_HEADER = struct.Struct("<IIQQQQQQ")
+SECTION_HEADER = struct.Struct("<IIQQQQIIQQ")
+SYMBOL = struct.Struct("<IBBHQQ")
+
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+
+
+def symbol_offset(path, name):
+    # Returns the address of symbol name in the x86_64 ELF at path, relative
+    # to where its first segment is loaded, like breakpoint addresses
+    with open(path, "rb") as f:
+        data = f.read()
+
+    (
+        ident,
+        _type,
+        _machine,
+        _version,
+        _entry,
+        phoff,
+        shoff,
+        _flags,
+        _ehsize,
+        phentsize,
+        phnum,
+        shentsize,
+        shnum,
+        _shstrndx,
+    ) = ELF_HEADER.unpack_from(data)
+    if ident[:5] != b"\x7fELF\x02":
+        raise ValueError(f"Not a 64-bit ELF: {path}")
+
+    load_addresses = []
+    for i in range(phnum):
+        p_type, _, _, p_vaddr, _, _, _, p_align = PROGRAM_HEADER.unpack_from(
+            data, phoff + i * phentsize
+        )
+        if p_type == PT_LOAD:
+            load_addresses.append(p_vaddr & ~(max(p_align, 1) - 1))
+    base_address = min(load_addresses)
+
+    sections = [
+        SECTION_HEADER.unpack_from(data, shoff + i * shentsize) for i in range(shnum)
+    ]
+    encoded_name = name.encode()
+    for symbol_type in (SHT_SYMTAB, SHT_DYNSYM):
+        for section in sections:
+            if section[1] != symbol_type:
+                continue
+            _, _, _, _, offset, size, link, _, _, entsize = section
+            strtab_offset = sections[link][4]
+            for entry_offset in range(offset, offset + size, entsize):
+                st_name, _, _, st_shndx, st_value, _ = SYMBOL.unpack_from(
+                    data, entry_offset
+                )
+                if not st_shndx or not st_value:
+                    continue
+                name_end = data.index(b"\0", strtab_offset + st_name)
+                if data[strtab_offset + st_name : name_end] == encoded_name:
+                    return st_value - base_address
+
+    raise KeyError(f"Symbol {name} not found in {path}")
@@ -0,0 +1,79 @@
+import re
+import array
+import itertools
+
+
+VARINT_PATTERN = re.compile(b"[\x80-\xff]*[\x00-\x7f]")
+RECORD_PATTERN = re.compile(b"[\x80-\xff]")
+MAX_CACHED_VARINTS = 0x10000
+ADDRESS_MASK = 0xFFFFFFFFFFFFFFFF
+RECORD_FLAG = 1 << 63
+
+
+class ZigzagVarints(dict):
+    def __missing__(self, varint):
+        value = 0
+        for shift, byte in enumerate(varint):
+            value |= (byte & 0x7F) << (7 * shift)
+        delta = (value >> 1) ^ -(value & 1)
+        if len(self) < MAX_CACHED_VARINTS:
+            self[varint] = delta
+        return delta
+
+
+zigzag_varints = ZigzagVarints()
+SINGLE_BYTE_DELTAS = [zigzag_varints[bytes([byte])] for byte in range(0x80)]
+
+
+def encode_deltas(addresses):
+    result = bytearray()
+    prev = 0
+    for address in addresses:
+        delta = (address - prev) & ADDRESS_MASK
+        delta -= (delta >> 63) << 64
+        prev = address
+        value = (delta << 1) ^ (delta >> 63)
+        value &= ADDRESS_MASK
+        while value > 0x7F:
+            result.append((value & 0x7F) | 0x80)
+            value >>= 7
+        result.append(value)
+    return bytes(result)
+
+
+def decode_deltas(data):
+    # Successive addresses are usually close, so the same few varints repeat
+    # and their decoded deltas are served from the zigzag_varints cache.
+    data = bytes(data)
+    if data.isascii():
+        deltas = list(map(SINGLE_BYTE_DELTAS.__getitem__, data))
+    else:
+        varints = VARINT_PATTERN.findall(data)
+        deltas = list(map(zigzag_varints.__getitem__, varints))
+    try:
+        return array.array("Q", itertools.accumulate(deltas))
+    except OverflowError:
+        # The deltas were computed modulo 2**64
+        addresses = itertools.accumulate(deltas)
+        return array.array("Q", (address & ADDRESS_MASK for address in addresses))
+
+
+def split_records(words):
+    # Record words have their top bit set, so only the most significant byte
+    # of each word needs to be searched to find them.
+    top_bytes = memoryview(words).cast("B")[7::8].tobytes()
+    position = 0
+    while True:
+        match = RECORD_PATTERN.search(top_bytes, position)
+        if not match:
+            break
+        index = match.start()
+        if index > position:
+            yield None, words[position:index]
+        header = words[index]
+        kind = (header & ~RECORD_FLAG) >> 32
+        length = header & 0xFFFFFFFF
+        yield kind, words[index + 1 : index + 1 + length]
+        position = index + 1 + length
+    if position < len(words):
+        yield None, words[position:]
@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import collections
+import concurrent.futures
+
+from .async_machine import AsyncTraceMachine
+from .coverage import Coverage, EdgeBitmap
+from .syscalls import syscalls
+
+
+Job = collections.namedtuple(
+    "Job", "argv stdin mode trace_path", defaults=(None, "trace", None)
+)
+
+
+class StartupError(Exception):
+    pass
+
+
+def syscall_name(syscall_nr):
+    # Syscalls newer than the table are still counted, by number
+    table = syscalls["x86_64"]
+    if 0 <= syscall_nr < len(table):
+        return table[syscall_nr][1]
+    return f"syscall_{syscall_nr}"
+
+
+class FarmMachine(AsyncTraceMachine):
+    # Only counts basic blocks unless they are streamed to a trace file
+    def __init__(self, argv, **kwargs):
+        super().__init__(argv, **kwargs)
+        self.num_bbs = 0
+
+    def setup(self):
+        try:
+            super().setup()
+        except Exception as e:
+            raise StartupError(e) from e
+
+    def on_basic_block_batch(self, addresses, sequence):
+        self.num_bbs += len(addresses)
+        if self.trace_path is not None:
+            super().on_basic_block_batch(addresses, sequence)
+
+    def summary(self):
+        syscall_counts = collections.Counter(
+            syscall_name(event[1]) for event in self.filtered_trace("syscall_start")
+        )
+        result = {
+            "num_bbs": self.num_bbs,
+            "syscalls": dict(syscall_counts),
+            "output_size": sum(len(event[2]) for event in self.filtered_trace("output")),
+        }
+        if self.mode == "count":
+            result["num_bbs"] = sum(self.bb_counts.values())
+            result["bb_counts"] = self.bb_counts
+        elif self.mode == "edges":
+            result["edge_bitmap"] = bytes(self.edge_bitmap)
+        if self.trace_path is not None:
+            result["trace_path"] = str(self.trace_path)
+        return result
+
+
+def run_job(job, *, timeout=None, retries=2):
+    result = {"argv": [str(arg) for arg in job.argv], "attempts": 0}
+    start_time = time.perf_counter()
+
+    while True:
+        result["attempts"] += 1
+        machine = FarmMachine(
+            job.argv, stdin=job.stdin, mode=job.mode, trace_path=job.trace_path
+        )
+        try:
+            asyncio.run(asyncio.wait_for(machine.run(), timeout))
+            # Failing to summarize is an error of this job alone
+            summary = machine.summary()
+        except asyncio.TimeoutError:
+            result["status"] = "timeout"
+        except StartupError as e:
+            # QEMU occasionally fails to come up, which is worth another try
+            if result["attempts"] <= retries:
+                continue
+            result["status"] = "error"
+            result["error"] = repr(e.__cause__)
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = repr(e)
+        else:
+            result["status"] = "ok"
+            result.update(summary)
+        break
+
+    result["time"] = time.perf_counter() - start_time
+    return result
+
+
+class TraceFarm:
+    def __init__(self, *, num_workers=None, timeout=None, retries=2):
+        self.num_workers = num_workers or os.cpu_count()
+        self.timeout = timeout
+        self.retries = retries
+        self.coverage = Coverage()
+        self.stats = collections.Counter()
+        self.start_time = None
+
+    def run(self, jobs):
+        # Yields (job, result) pairs as jobs complete
+        self.start_time = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(self.num_workers) as executor:
+            futures = {
+                executor.submit(
+                    run_job, job, timeout=self.timeout, retries=self.retries
+                ): job
+                for job in map(self.job, jobs)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                self.update(result)
+                yield futures[future], result
+
+    def job(self, job):
+        if isinstance(job, Job):
+            return job
+        if isinstance(job, dict):
+            return Job(**job)
+        return Job(job)
+
+    def update(self, result):
+        self.stats["jobs"] += 1
+        self.stats[result["status"]] += 1
+        self.stats["attempts"] += result["attempts"]
+        self.stats["bbs"] += result.get("num_bbs", 0)
+        if "edge_bitmap" in result:
+            self.coverage.update(EdgeBitmap(result["edge_bitmap"]))
+
+    @property
+    def throughput(self):
+        total_time = time.perf_counter() - self.start_time
+        return {
+            "time": total_time,
+            "jobs_per_second": self.stats["jobs"] / total_time,
+            "bbs_per_second": self.stats["bbs"] / total_time,
+        }
@@ -0,0 +1,173 @@
+import os
+import array
+import signal
+import socket
+import tempfile
+
+from .machine import TraceMachine, TRACE_REASON, REQUEST_FORK
+from .elf import symbol_offset
+
+
+class ForkedProcess:
+    # Stands in for the Popen of a forked target, which is a child of the
+    # fork server's QEMU rather than of this process
+    def __init__(self, server, pid):
+        self.server = server
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.server.handle_trace_until(TRACE_REASON.trace_fork_exit)
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class ForkServer(TraceMachine):
+    # Runs the target once, up to address (the entry of main by default),
+    # and from there forks a copy of it for every run. Runs skip QEMU
+    # startup, dynamic linking and translating everything executed before
+    # address, but forked targets have no gdbstub, so no breakpoints.
+    def __init__(self, argv, *, address=None, machine_class=TraceMachine, **kwargs):
+        super().__init__(argv, **kwargs)
+        if address is None:
+            address = symbol_offset(argv[0], "main")
+        self.address = address
+        self.machine_class = machine_class
+        # Forked targets handle syscalls as the plugin was started with
+        self.synchronous_syscalls = machine_class.synchronous_syscalls
+        self.fork_process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        plugin_args, pass_fds = self.create_channel()
+        plugin_args.append(f"binary_path={os.path.realpath(self.argv[0])}")
+        plugin_args.append(f"fork_offset={self.address:#x}")
+        self.spawn([], plugin_args, pass_fds)
+
+    def setup(self):
+        self.start()
+        self.handle_trace_until(TRACE_REASON.trace_fork_server)
+        self.update_maps()
+
+    def close(self):
+        if self.fork_process is not None:
+            self.fork_process.kill()
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def run(self, **kwargs):
+        # Runs a forked target to completion and returns its machine
+        machine = self.machine_class(
+            self.argv,
+            transport=self.transport,
+            window=self.window,
+            mode=self.mode,
+            encoding=self.encoding,
+            rle=self.rle,
+            syscall_allowlist=self.syscall_allowlist,
+            syscall_denylist=self.syscall_denylist,
+            drop_filtered_syscalls=self.drop_filtered_syscalls,
+            fork_server=self,
+            **kwargs,
+        )
+        machine.run()
+        machine.process.wait()
+        return machine
+
+    def fork(self, machine):
+        # Starts machine on a new fork of the target, in place of spawning it
+        if self.trace_config(machine) != self.trace_config(self):
+            raise ValueError("Forked targets must be traced like their fork server")
+        if machine.transport == "socket" and machine.window != self.window:
+            raise ValueError("Forked targets must be traced like their fork server")
+
+        if self.process is None:
+            self.setup()
+        # Targets are forked one at a time
+        if self.fork_process is not None:
+            self.fork_process.wait()
+
+        _, pass_fds = machine.create_channel()
+
+        if machine.stdin is not None:
+            stdin = tempfile.TemporaryFile()
+            stdin.write(machine.stdin)
+            stdin.seek(0)
+            stdin_fd = os.dup(stdin.fileno())
+            stdin.close()
+            stdin_writer = None
+        else:
+            stdin_fd, stdin_writer = os.pipe()
+            stdin_writer = os.fdopen(stdin_writer, "wb")
+        stdout_reader, stdout_fd = os.pipe()
+        stderr_reader, stderr_fd = os.pipe()
+
+        fds = [pass_fds[0], stdin_fd, stdout_fd, stderr_fd, *pass_fds[1:]]
+        try:
+            self.trace_socket.sendmsg(
+                [REQUEST_FORK],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))],
+            )
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.handle_trace_until(TRACE_REASON.trace_fork)
+
+        machine.maps = dict(self.maps)
+        machine.guest_base = self.guest_base
+        machine.process = self.fork_process
+        machine.std_streams = (
+            stdin_writer,
+            os.fdopen(stdout_reader, "rb"),
+            os.fdopen(stderr_reader, "rb"),
+        )
+
+    @staticmethod
+    def trace_config(machine):
+        # Everything the plugin is started with, which forked targets inherit
+        return (
+            machine.transport,
+            machine.mode,
+            machine.encoding,
+            machine.rle,
+            machine.syscall_allowlist,
+            machine.syscall_denylist,
+            machine.drop_filtered_syscalls,
+            machine.synchronous_syscalls,
+        )
+
+    def handle_trace_reason(self, trace_header):
+        reason = super().handle_trace_reason(trace_header)
+
+        if reason == TRACE_REASON.trace_fork_server:
+            self.ack()
+
+        elif reason == TRACE_REASON.trace_fork:
+            self.fork_process = ForkedProcess(self, trace_header.syscall_data[0])
+            self.ack()
+
+        elif reason == TRACE_REASON.trace_fork_exit:
+            status = trace_header.syscall_data[0]
+            if os.WIFSIGNALED(status):
+                self.fork_process.returncode = -os.WTERMSIG(status)
+            else:
+                self.fork_process.returncode = os.WEXITSTATUS(status)
+            self.ack()
+
+        return reason
@@ -1,9 +1,37 @@
-from .gdb_minimal_client import gdb_minimal_client
+import operator
 
+from .gdb_minimal_client import gdb_minimal_client, gdb_rsp_client
+
+
+# Breakpoint conditions compare a register to a value as unsigned 64-bit
+# integers. Their order is the plugin's enum breakpoint_op.
+BREAKPOINT_CONDITIONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "&": lambda register, value: bool(register & value),
+}
+
+
+def breakpoint(address, *, count_only=False, every=1, condition=None):
+    # Breakpoints count their hits in TraceMachine.breakpoint_hits, and only
+    # call func on every Nth hit where condition, a (register, operator,
+    # value) tuple, holds. count_only breakpoints never call func.
+    if every < 1:
+        raise ValueError("every must be at least 1")
+    if condition is not None:
+        register, op, value = condition
+        if op not in BREAKPOINT_CONDITIONS:
+            raise ValueError(f"Unknown breakpoint condition: {op}")
+        condition = (register, op, value & 0xFFFFFFFFFFFFFFFF)
 
-def breakpoint(address):
     def wrapper(func):
         func.gdb_breakpoint_address = address
+        func.breakpoint_every = 0 if count_only else every
+        func.breakpoint_condition = condition
         return func
 
     return wrapper
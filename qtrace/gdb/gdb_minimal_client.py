@@ -1,5 +1,3 @@
-import contextlib
-
 from ..utils import create_connection
 
 amd64 = {
@@ -66,49 +64,132 @@ amd64 = {
     "bits": 64,
 }
 
+# QEMU's stub caps packets at 4096 bytes, so hex replies at half of that
+MEMORY_CHUNK_SIZE = 0x800
+
+
+def decode_packet(data):
+    # Undoes the escaping and run-length encoding of a packet's payload
+    if b"}" not in data and b"*" not in data:
+        return data
+    result = bytearray()
+    i = 0
+    while i < len(data):
+        byte = data[i]
+        if byte == ord("}"):
+            result.append(data[i + 1] ^ 0x20)
+            i += 2
+        elif byte == ord("*"):
+            result += result[-1:] * (data[i + 1] - 29)
+            i += 2
+        else:
+            result.append(byte)
+            i += 1
+    return bytes(result)
+
 
 class GDB:
-    def __init__(self, address, *, arch=amd64):
+    def __init__(self, address, *, arch=amd64, machine=None, rsp_memory=False):
         self.socket = create_connection(address)
+        self.buffer = bytearray()
+        self.no_ack = False
         self.arch = arch
-        self.registers = self.fetch_registers()
+        self.start_no_ack_mode()
+        # Registers and memory are only cached while the target is stopped
+        self.registers = {}
+        self.memory_cache = {}
+        self.p_supported = None
+        self.x_supported = None
         self.breakpoints = {}
-        self.memory = Memory(self)
+        # Memory is read straight from the machine's QEMU process, unless
+        # rsp_memory asks for the stub's m and x packets
+        self.memory = Memory(self, None if rsp_memory else machine)
 
     def checksum(self, data):
         if isinstance(data, str):
             data = data.encode()
         return sum(data) % 256
 
+    def encode(self, cmd):
+        if isinstance(cmd, str):
+            cmd = cmd.encode()
+        return b"$" + cmd + f"#{self.checksum(cmd):02x}".encode()
+
     def send(self, cmd):
-        checksum = self.checksum(cmd)
-        self.socket.send(f"${cmd}#{checksum:02x}".encode())
-        assert self.socket.recv(1) == b"+"
+        self.socket.sendall(self.encode(cmd))
+        if not self.no_ack:
+            while not self.buffer:
+                self.fill_buffer()
+            assert self.buffer[0] == ord("+")
+            del self.buffer[0]
 
     def recv(self, ok=False):
-        assert self.socket.recv(1) == b"$"
-        result = b""
         while True:
-            b = self.socket.recv(1)
-            if b == b"#":
+            result = self.parse_packet()
+            if result is not None:
                 break
-            result += b
-        checksum = int(self.socket.recv(2), 16)
-        assert checksum == self.checksum(result)
-        self.socket.send(b"+")
+            self.fill_buffer()
+        if not self.no_ack:
+            self.socket.send(b"+")
         if ok:
             assert result == b"OK"
         return result
 
+    def start_no_ack_mode(self):
+        # Stubs that support it stop acknowledging packets, and so do we
+        self.send("QStartNoAckMode")
+        self.no_ack = self.recv() == b"OK"
+
+    def pipeline(self, cmds):
+        # Returns the replies to cmds in order. Without acks, all of them are
+        # sent at once, before waiting for any reply; with acks, the stub
+        # would take the next request for the ack of its reply.
+        if not self.no_ack:
+            replies = []
+            for cmd in cmds:
+                self.send(cmd)
+                replies.append(self.recv())
+            return replies
+        self.socket.sendall(b"".join(self.encode(cmd) for cmd in cmds))
+        return [self.recv() for _ in cmds]
+
+    def fill_buffer(self):
+        # Reads whatever is available, which may be several packets
+        data = self.socket.recv(0x10000)
+        if not data:
+            raise EOFError("gdbstub closed the connection")
+        self.buffer += data
+
+    def buffered(self):
+        # Whether a packet was already read ahead, which select will not see
+        return b"$" in self.buffer
+
+    def parse_packet(self):
+        buffer = self.buffer
+        start = buffer.find(b"$")
+        if start == -1:
+            return
+        end = buffer.find(b"#", start)
+        if end == -1 or len(buffer) < end + 3:
+            return
+        data = bytes(buffer[start + 1 : end])
+        checksum = int(buffer[end + 1 : end + 3], 16)
+        del buffer[: end + 3]
+        assert checksum == self.checksum(data)
+        return decode_packet(data)
+
     def detach(self):
-        for address in self.breakpoints:
-            self.send(f"z0,{address:x},2")
-            self.recv(ok=True)
-        self.send("D")
-        self.recv(ok=True)
+        cmds = [f"z0,{address:x},2" for address in self.breakpoints]
+        replies = self.pipeline([*cmds, "D"])
+        assert all(reply == b"OK" for reply in replies)
         self.socket.close()
 
+    def invalidate(self):
+        self.registers = {}
+        self.memory_cache.clear()
+
     def step(self):
+        self.invalidate()
         self.send("s")
         assert self.recv() == b"S05"
 
@@ -125,68 +206,152 @@ class GDB:
         }
         return self.registers
 
+    def register(self, name):
+        if name not in self.registers:
+            self.fetch_register(name)
+        return self.registers[name]
+
+    def fetch_register(self, name):
+        # A single register is fetched with p, unless the stub only has g
+        if self.p_supported is not False:
+            self.send(f"p{self.arch['regs'].index(name):x}")
+            response = self.recv()
+            # An empty reply means p is not supported at all
+            self.p_supported = bool(response)
+            if response and not response.startswith(b"E"):
+                value = bytes.fromhex(response.decode())
+                self.registers[name] = int.from_bytes(value, self.arch["endian"])
+                return
+        self.fetch_registers()
+
     def fetch_memory(self, address, length):
-        self.send(f"m{address:x},{length}")
-        response = self.recv()
+        return self.fetch_memory_regions([(address, length)])[0]
+
+    def fetch_memory_regions(self, regions):
+        # Reads each (address, length) region, with a single round trip
+        # when the stub does not ack. Binary x reads are used where the stub
+        # supports them, which halves the size of the replies.
+        regions = list(regions)
+        results = []
+        if self.x_supported is None and regions:
+            address, length = regions.pop(0)
+            self.send(f"x{address:x},{length:x}")
+            response = self.recv()
+            self.x_supported = bool(response)
+            if self.x_supported:
+                results.append(self.decode_memory(response, address))
+            else:
+                regions.insert(0, (address, length))
+
+        cmd = "x" if self.x_supported else "m"
+        replies = self.pipeline(
+            [f"{cmd}{address:x},{length:x}" for address, length in regions]
+        )
+        for (address, _), reply in zip(regions, replies):
+            results.append(self.decode_memory(reply, address))
+        return results
+
+    def decode_memory(self, response, address):
+        if response.startswith(b"E") and len(response) == 3:
+            raise Exception(f"Failed to read memory at {address:#x}: {response}")
+        if self.x_supported:
+            return response[1:]
         return bytes.fromhex(response.decode())
 
+    def read_memory(self, address, length):
+        # Served from chunks cached until the target resumes
+        start = address - address % MEMORY_CHUNK_SIZE
+        chunks = range(start, address + length, MEMORY_CHUNK_SIZE)
+        missing = [chunk for chunk in chunks if chunk not in self.memory_cache]
+        if missing:
+            regions = [(chunk, MEMORY_CHUNK_SIZE) for chunk in missing]
+            for chunk, data in zip(missing, self.fetch_memory_regions(regions)):
+                self.memory_cache[chunk] = data
+        data = b"".join(self.memory_cache[chunk] for chunk in chunks)
+        return data[address - start : address - start + length]
+
     def add_breakpoint(self, address, callback):
-        assert address not in self.breakpoints
-        self.send(f"Z0,{address:x},2")
-        self.recv(ok=True)
-        self.breakpoints[address] = callback
+        self.add_breakpoints({address: callback})
+
+    def add_breakpoints(self, breakpoints):
+        # Inserts every breakpoint of an {address: callback} dict at once
+        assert not breakpoints.keys() & self.breakpoints.keys()
+        replies = self.pipeline([f"Z0,{address:x},2" for address in breakpoints])
+        assert all(reply == b"OK" for reply in replies)
+        self.breakpoints.update(breakpoints)
 
     def handle_sigtrap(self):
-        self.fetch_registers()
-        callback = self.breakpoints[self.rip]
-        callback()
+        return self.breakpoints[self.rip]
+
+    def resume(self):
+        # The continue is only sent once the step is done; a stub handling
+        # both at once would take the continue while still single-stepping
         self.step()
         self.async_continue()
 
     def async_continue(self):
+        self.invalidate()
         self.send("c")
 
-    def async_recv(self):
+    def recv_stop(self):
+        # Returns the callback of the breakpoint the target stopped at, or
+        # None once it has exited
         response = self.recv()
         if response.startswith(b"W"):
             assert len(response) == 3
             code = int(response[1:], 16)
-            return False
+            return None
         elif response.startswith(b"S"):
             assert len(response) == 3
             code = int(response[1:], 16)
             assert code == 5
-            self.handle_sigtrap()
-            return True
+            return self.handle_sigtrap()
         else:
             raise Exception(f"Unknown response from gdb: {response}")
 
+    def async_recv(self):
+        callback = self.recv_stop()
+        if callback is None:
+            return False
+        callback()
+        self.resume()
+        return True
+
     def __getitem__(self, key):
         if isinstance(key, str):
-            with contextlib.suppress(KeyError):
-                return self.registers[key]
+            if key in self.arch["regs"]:
+                return self.register(key)
         elif isinstance(key, slice):
             if key.step is None:
-                return self.fetch_memory(key.start, key.stop - key.start)
+                return self.memory[key]
         raise TypeError("Key must be a valid register or memory region")
 
     def __getattr__(self, name):
-        with contextlib.suppress(KeyError):
-            return self.registers[name]
+        arch = self.__dict__.get("arch")
+        if arch is not None and name in arch["regs"]:
+            return self.register(name)
         raise AttributeError(name)
 
 
 class Memory:
-    def __init__(self, gdb):
+    def __init__(self, gdb, machine=None):
         self.gdb = gdb
+        self.machine = machine
 
     def __getitem__(self, key):
         if isinstance(key, slice):
+            if self.machine is not None:
+                # The target's memory is read from its QEMU process
+                return self.machine.memory[key]
             address = key.start
             length = key.stop - key.start
-            return self.gdb.fetch_memory(address, length)
+            return self.gdb.read_memory(address, length)
         raise KeyError()
 
 
 def gdb_minimal_client(address, machine):
-    return GDB(address)
+    return GDB(address, machine=machine)
+
+
+def gdb_rsp_client(address, machine):
+    return GDB(address, machine=machine, rsp_memory=True)
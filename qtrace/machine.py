@@ -1,5 +1,6 @@
 import os
 import re
+import mmap
 import socket
 import fcntl
 import select
@@ -7,14 +8,24 @@ import termios
 import array
 import enum
 import ctypes
+import struct
+import collections
+import shutil
+import tempfile
 import subprocess
 import pathlib
 
+from .encoding import decode_deltas, split_records
+from .trace import Trace, signed
+from .tracefile import TraceWriter, TraceFile
+from .memory import ProcessMemory
+from .gdb import BREAKPOINT_CONDITIONS
 from . import (
-    create_connection,
     syscalls,
     syscall_description,
     gdb_minimal_client,
+    EDGE_MAP_SIZE,
+    EdgeBitmap,
     LD_PATH,
     LIBS_PATH,
     QEMU_PATH,
@@ -23,6 +34,7 @@ from . import (
 
 
 TRACE_MAX_BB_ADDRS = 0x1000
+TRACE_WINDOW = 8
 
 
 class TRACE_REASON(enum.Enum):
@@ -30,6 +42,25 @@ class TRACE_REASON(enum.Enum):
     trace_syscall_start = 1
     trace_syscall_end = 2
     trace_async = 3
+    trace_maps = 4
+    trace_counts = 5
+    trace_fork_server = 6
+    trace_fork = 7
+    trace_fork_exit = 8
+    trace_guest_base = 9
+    trace_breakpoint = 10
+    trace_breakpoint_hits = 11
+
+
+class TRACE_ENCODING(enum.Enum):
+    encoding_raw = 0
+    encoding_delta = 1
+
+
+class TRACE_RECORD(enum.Enum):
+    record_run = 0
+    record_syscall_start = 1
+    record_syscall_end = 2
 
 
 class SYSCALL_START_DATA(ctypes.Structure):
@@ -52,6 +83,9 @@ class SYSCALL_DATA(ctypes.Union):
     _fields_ = [
         ("syscall_start_data", SYSCALL_START_DATA),
         ("syscall_ret", ctypes.c_int64),
+        ("maps_size", ctypes.c_uint64),
+        ("guest_base", ctypes.c_uint64),
+        ("breakpoint", ctypes.c_uint64),
     ]
 
 
@@ -62,11 +96,34 @@ class TRACE_INFO(ctypes.Structure):
 class TRACE_HEADER(ctypes.Structure):
     _fields_ = [
         ("reason", ctypes.c_uint),
+        ("encoding", ctypes.c_uint),
         ("num_addrs", ctypes.c_uint64),
+        ("num_bytes", ctypes.c_uint64),
+        ("num_records", ctypes.c_uint64),
         ("info", TRACE_INFO),
     ]
 
 
+# TRACE_HEADER flattened: reason, encoding, num_addrs, num_bytes, num_records,
+# syscall_num and the eight words of syscall_data
+TRACE_HEADER_STRUCT = struct.Struct("<IIQQQq8Q")
+assert TRACE_HEADER_STRUCT.size == ctypes.sizeof(TRACE_HEADER)
+
+
+class TraceHeader(
+    collections.namedtuple(
+        "TraceHeader",
+        "reason encoding num_addrs num_bytes num_records syscall_num syscall_data",
+    )
+):
+    __slots__ = ()
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        fields = TRACE_HEADER_STRUCT.unpack_from(buffer, offset)
+        return cls._make((*fields[:6], fields[6:]))
+
+
 class TRACE(ctypes.Structure):
     _fields_ = [
         ("header", TRACE_HEADER),
@@ -74,27 +131,148 @@ class TRACE(ctypes.Structure):
     ]
 
 
+class TRACE_RING(ctypes.Structure):
+    _fields_ = [
+        ("head", ctypes.c_uint64),
+        ("tail", ctypes.c_uint64),
+        ("num_slots", ctypes.c_uint64),
+    ]
+
+
+# The registers following a trace_breakpoint, in CPUX86State order
+Registers = collections.namedtuple(
+    "Registers",
+    "rax rcx rdx rbx rsp rbp rsi rdi r8 r9 r10 r11 r12 r13 r14 r15 rip",
+)
+REGISTERS_STRUCT = struct.Struct(f"<{len(Registers._fields)}Q")
+
+TRACE_SIZE = ctypes.sizeof(TRACE)
+TRACE_RING_SIZE = ctypes.sizeof(TRACE_RING)
+RESPONSE_ACK = (0).to_bytes(8, "little")
+RESPONSE_CREDIT = (3).to_bytes(8, "little")
+REQUEST_FORK = (4).to_bytes(8, "little")
+
+# Large enough for a full trace followed by the largest maps reply
+TRACE_RECV_BUFFER_SIZE = 4 * TRACE_SIZE
+
+# Syscalls missing from the table, newer than it, may use all 6 arguments
+SYSCALL_NUM_ARGS = {
+    syscall_definition[0]: len(syscall_definition[2:])
+    for syscall_definition in syscalls["x86_64"]
+}
+SYSCALL_MAX_ARGS = 6
+
+# Syscall numbers by name, with or without the sys_ prefix
+SYSCALL_NUMBERS = {}
+for syscall_definition in syscalls["x86_64"]:
+    syscall_nr, syscall_name = syscall_definition[:2]
+    SYSCALL_NUMBERS[syscall_name] = syscall_nr
+    if syscall_name.startswith("sys_"):
+        SYSCALL_NUMBERS[syscall_name[len("sys_") :]] = syscall_nr
+
+
+def skip_first_address(addresses, repeats):
+    # Returns the runs of addresses repeated repeats times, less the first
+    runs = [(addresses[1:], 1)] if len(addresses) > 1 else []
+    if repeats > 1:
+        runs.append((addresses, repeats - 1))
+    return runs
+
+
+def syscall_number(syscall):
+    if isinstance(syscall, int):
+        return syscall
+    try:
+        return SYSCALL_NUMBERS[syscall]
+    except KeyError:
+        raise ValueError(f"Unknown syscall: {syscall}") from None
+
+
 class TraceMachine:
-    def __init__(self, argv, *, gdb_client=None):
+    # Syscall events arrive among the basic blocks, without stopping the
+    # target. Subclasses that need the target stopped in on_syscall_start and
+    # on_syscall_end, e.g. to access its memory, set this.
+    synchronous_syscalls = False
+
+    def __init__(
+        self,
+        argv,
+        *,
+        gdb_client=None,
+        transport=None,
+        window=TRACE_WINDOW,
+        mode="trace",
+        encoding="raw",
+        rle=False,
+        trace_path=None,
+        stdin=None,
+        fork_server=None,
+        plugin_breakpoints=False,
+        syscall_allowlist=None,
+        syscall_denylist=None,
+        drop_filtered_syscalls=False,
+    ):
         if gdb_client is None:
             gdb_client = gdb_minimal_client
+        if transport is None:
+            transport = "ring" if hasattr(os, "memfd_create") else "socket"
+        if transport not in ("ring", "socket"):
+            raise ValueError(f"Unknown transport: {transport}")
+        if mode not in ("trace", "count", "edges"):
+            raise ValueError(f"Unknown mode: {mode}")
+        if encoding not in ("raw", "delta"):
+            raise ValueError(f"Unknown encoding: {encoding}")
 
         self.argv = argv
         self.gdb_client = gdb_client
-        self.trace = []
+        self.transport = transport
+        self.window = window
+        self.mode = mode
+        self.encoding = encoding
+        self.rle = rle
+        self.trace_path = trace_path
+        self.stdin = stdin
+        self.fork_server = fork_server
+        self.plugin_breakpoints = plugin_breakpoints
+        if syscall_allowlist is not None:
+            syscall_allowlist = {syscall_number(s) for s in syscall_allowlist}
+        if syscall_denylist is not None:
+            syscall_denylist = {syscall_number(s) for s in syscall_denylist}
+        self.syscall_allowlist = syscall_allowlist
+        self.syscall_denylist = syscall_denylist
+        self.drop_filtered_syscalls = drop_filtered_syscalls
+        self.trace = Trace() if trace_path is None else TraceWriter(trace_path)
+        self.bb_counts = {}
+        self.edge_bitmap = None
         self.maps = {}
+        self.guest_base = None
+        self.registers = None
+        self.breakpoint_hits = {}
 
         self.trace_socket = None
+        self.trace_buffer = memoryview(bytearray(TRACE_RECV_BUFFER_SIZE))
+        self.trace_buffer_start = 0
+        self.trace_buffer_end = 0
+        self.pending_credits = 0
+        self.trace_sequence = -1
+        self.trace_ring = None
+        self.trace_ring_header = None
         self.gdb = None
+        self.process = None
         self.std_streams = None
 
+        self._memory = None
+        self._breakpoint_callbacks = []
+        self._binary_base = None
         self._skip_breakpoint_trace_address = False
 
     @property
     def breakpoints(self):
         result = []
         for name in dir(self):
-            if name == "breakpoints":
+            # Properties such as this one are not breakpoints, and may not
+            # be safe to evaluate
+            if isinstance(getattr(type(self), name, None), property):
                 continue
             value = getattr(self, name)
             if hasattr(value, "gdb_breakpoint_address"):
@@ -103,7 +281,14 @@ class TraceMachine:
 
     @property
     def binary_base_address(self):
+        if self._binary_base is not None:
+            return self._binary_base
         if not self.maps:
+            if self.plugin_breakpoints:
+                raise RuntimeError(
+                    "No program maps found, with plugin breakpoints the binary "
+                    "base address is only known from the first breakpoint hit"
+                )
             raise RuntimeError("No program maps found, is the target running?")
         binary_name = pathlib.Path(self.argv[0]).name
         for region, mapping in self.maps.items():
@@ -114,61 +299,259 @@ class TraceMachine:
                 return start_address
         raise Exception("Could not find base address of binary")
 
-    def start(self):
+    @property
+    def memory(self):
+        # Guest memory, read and written straight from the QEMU process
+        if self.guest_base is None:
+            # The plugin only learns guest_base once it translates a block
+            raise RuntimeError("Guest memory is not accessible before the target runs")
+        if self._memory is None:
+            self._memory = ProcessMemory(self.process.pid, self.guest_base)
+        return self._memory
+
+    def create_shared_memory(self, name, size):
+        fd = os.memfd_create(name)
+        os.ftruncate(fd, size)
+        return fd, mmap.mmap(fd, size)
+
+    def create_ring(self, num_slots):
+        ring_size = ctypes.sizeof(TRACE_RING) + num_slots * ctypes.sizeof(TRACE)
+        ring_fd, self.trace_ring = self.create_shared_memory("qtrace-ring", ring_size)
+        self.trace_ring_header = TRACE_RING.from_buffer(self.trace_ring)
+        self.trace_ring_header.num_slots = num_slots
+        return ring_fd
+
+    def create_channel(self):
+        # Creates this target's trace socketpair and shared memory, returning
+        # the plugin arguments and the file descriptors to hand to the plugin
+        self.trace_socket, plugin_trace_socket = socket.socketpair()
+        plugin_args = [f"trace_fd={plugin_trace_socket.fileno()}"]
+        pass_fds = [plugin_trace_socket.detach()]
+
+        if self.transport == "ring":
+            # One slot more than the window, for the slot being filled
+            ring_fd = self.create_ring(self.window + 1)
+            plugin_args.append(f"ring_fd={ring_fd}")
+            pass_fds.append(ring_fd)
+        else:
+            plugin_args.append(f"window={self.window}")
+
+        if self.encoding != "raw":
+            plugin_args.append(f"encoding={self.encoding}")
+
+        if self.rle:
+            plugin_args.append("rle=on")
+
+        # Only the allowed syscalls, minus the denied ones, stop the target
+        if self.syscall_allowlist is not None:
+            listed = self.syscall_allowlist - (self.syscall_denylist or set())
+            syscall_filter = "allow"
+        elif self.syscall_denylist is not None:
+            listed = self.syscall_denylist
+            syscall_filter = "deny"
+        else:
+            syscall_filter = None
+        if syscall_filter is not None:
+            listed = ":".join(map(str, sorted(listed)))
+            plugin_args.append(f"syscall_filter={syscall_filter}:{listed}")
+        if self.drop_filtered_syscalls:
+            plugin_args.append("syscall_drop=on")
+        if not self.synchronous_syscalls:
+            plugin_args.append("syscall_events=async")
+
+        if self.mode == "count":
+            plugin_args.append(f"mode={self.mode}")
+        elif self.mode == "edges":
+            edges_fd, edge_map = self.create_shared_memory("qtrace-edges", EDGE_MAP_SIZE)
+            self.edge_bitmap = EdgeBitmap(edge_map)
+            plugin_args.append(f"edges_fd={edges_fd}")
+            pass_fds.append(edges_fd)
+
+        return plugin_args, pass_fds
+
+    def spawn(self, qemu_args, plugin_args, pass_fds):
+        plugin = ",".join([str(QTRACE_PATH), *(f"arg={arg}" for arg in plugin_args)])
+
+        if self.stdin is not None:
+            # Given input is read from a file, so the target never blocks on it
+            stdin = tempfile.TemporaryFile()
+            stdin.write(self.stdin)
+            stdin.seek(0)
+        else:
+            stdin = subprocess.PIPE
+
         process = subprocess.Popen(
             [
                 LD_PATH,
                 "--library-path",
                 LIBS_PATH,
                 QEMU_PATH,
-                "-g",
-                "1234",
+                *qemu_args,
                 "-plugin",
-                QTRACE_PATH,
+                plugin,
                 *self.argv,
             ],
-            stdin=subprocess.PIPE,
+            stdin=stdin,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            pass_fds=pass_fds,
         )
 
-        self.trace_socket = create_connection(("localhost", 4242))
-        self.gdb = self.gdb_client(("localhost", 1234), self)
+        if self.stdin is not None:
+            stdin.close()
+        for fd in pass_fds:
+            os.close(fd)
+
+        self.process = process
         self.std_streams = (process.stdin, process.stdout, process.stderr)
 
-    def run(self):
+    def start(self):
+        if self.fork_server is not None:
+            self.fork_server.fork(self)
+            return
+
+        # Each target gets its own trace socketpair and gdbstub Unix socket,
+        # so any number of machines can run side by side
+        plugin_args, pass_fds = self.create_channel()
+
+        if self.plugin_breakpoints:
+            # The plugin stops at breakpoints itself, so there is no gdbstub
+            plugin_args.extend(self.breakpoint_args())
+            self.spawn([], plugin_args, pass_fds)
+            return
+
+        gdb_dir = tempfile.mkdtemp(prefix="qtrace-")
+        gdb_path = os.path.join(gdb_dir, "gdb")
+        try:
+            self.spawn(["-g", gdb_path], plugin_args, pass_fds)
+            self.gdb = self.gdb_client(gdb_path, self)
+        finally:
+            shutil.rmtree(gdb_dir, ignore_errors=True)
+
+    def setup(self):
+        self.breakpoint_hits = {callback.__name__: 0 for callback in self.breakpoints}
+        self._binary_base = None
+        # Checked before forking, so an invalid target is never started
+        forked = self.fork_server is not None
+        if forked and (self.breakpoints or self.plugin_breakpoints):
+            raise RuntimeError("Breakpoints are not supported in forked targets")
         self.start()
-        self.update_maps()
 
-        for callback in self.breakpoints:
+        if forked:
+            # Forked targets are already running, with the maps of their
+            # fork server, and have no gdbstub
+            return
 
-            def flush_callback(*, callback=callback):
-                self.request_flush()
-                callback()
-                self._skip_breakpoint_trace_address = True
+        if self.gdb is None:
+            # With plugin breakpoints the target is already running, and no
+            # maps are fetched; breakpoint offsets are resolved by the plugin
+            return
 
+        self.update_maps()
+
+        breakpoints = {}
+        for callback in self.breakpoints:
             address = callback.gdb_breakpoint_address + self.binary_base_address
-            self.gdb.add_breakpoint(address, flush_callback)
+            breakpoints[address] = self.breakpoint_callback(callback)
+        if breakpoints:
+            self.gdb.add_breakpoints(breakpoints)
 
         self.gdb.async_continue()
 
+    def breakpoint_args(self):
+        # Plugin breakpoints are numbered in the order of their offsets
+        callbacks = sorted(self.breakpoints, key=lambda c: c.gdb_breakpoint_address)
+        offsets = [callback.gdb_breakpoint_address for callback in callbacks]
+        if len(set(offsets)) != len(offsets):
+            raise ValueError("Only one breakpoint is supported per address")
+        self._breakpoint_callbacks = callbacks
+
+        # Each breakpoint is offset/every, followed by /register/op/value
+        # with a condition
+        specs = []
+        for callback in callbacks:
+            spec = f"{callback.gdb_breakpoint_address:#x}/{callback.breakpoint_every}"
+            if callback.breakpoint_condition is not None:
+                register, op, value = callback.breakpoint_condition
+                if register not in Registers._fields[:-1]:
+                    raise ValueError(f"Unknown breakpoint register: {register}")
+                register = Registers._fields.index(register)
+                op = list(BREAKPOINT_CONDITIONS).index(op)
+                spec += f"/{register}/{op}/{value:#x}"
+            specs.append(spec)
+
+        return [
+            f"binary_path={os.path.realpath(self.argv[0])}",
+            f"breakpoints={':'.join(specs)}",
+        ]
+
+    def handle_breakpoint(self, index, registers):
+        # Called only for the hits where the plugin found the breakpoint's
+        # condition to hold. The trace is already flushed, and the target
+        # waits for the ack, so the callback may read registers and access
+        # memory through self.memory, but must not request flushes or maps
+        self.registers = registers
+        try:
+            self._breakpoint_callbacks[index]()
+        finally:
+            self.registers = None
+        self.ack()
+
+    def breakpoint_callback(self, callback):
+        def flush_callback():
+            self.request_flush()
+            if self.breakpoint_fires(callback):
+                callback()
+            self._skip_breakpoint_trace_address = True
+
+        return flush_callback
+
+    def breakpoint_fires(self, callback):
+        # Counts a hit of a gdb breakpoint, and decides whether its callback
+        # runs, as the plugin does for plugin breakpoints
+        name = callback.__name__
+        self.breakpoint_hits[name] += 1
+        every = callback.breakpoint_every
+        if not every or self.breakpoint_hits[name] % every:
+            return False
+        if callback.breakpoint_condition is None:
+            return True
+        register, op, value = callback.breakpoint_condition
+        return BREAKPOINT_CONDITIONS[op](getattr(self.gdb, register), value)
+
+    def finish(self):
+        if isinstance(self.trace, TraceWriter):
+            self.trace.close()
+            self.trace = TraceFile(self.trace_path)
+
+    def run(self):
+        self.setup()
+
         stdin, stdout, stderr = self.std_streams
 
-        r_list = [self.trace_socket, self.gdb.socket, *filter(None, [stdout, stderr])]
+        gdb_socket = self.gdb.socket if self.gdb is not None else None
+        r_list = [self.trace_socket, *filter(None, [gdb_socket, stdout, stderr])]
         w_list = []
         x_list = []
         num_bytes = array.array("i", [0])
 
         while r_list:
+            # Data read ahead into receive buffers is not visible to select
+            trace_buffered = self.trace_buffered() and self.trace_socket in r_list
+            gdb_buffered = gdb_socket in r_list and self.gdb.buffered()
             r_available, w_available, x_available = select.select(
-                r_list, w_list, x_list
+                r_list, w_list, x_list, 0 if trace_buffered or gdb_buffered else None
             )
+            if trace_buffered and self.trace_socket not in r_available:
+                r_available.append(self.trace_socket)
+            if gdb_buffered and gdb_socket not in r_available:
+                r_available.append(gdb_socket)
 
             for r in r_available:
                 if r == self.trace_socket:
-                    data = self.handle_trace()
+                    data = self.handle_traces()
 
-                elif r == self.gdb.socket:
+                elif r == gdb_socket:
                     data = self.gdb.async_recv()
 
                 elif r == stdout:
@@ -184,73 +567,274 @@ class TraceMachine:
                 if not data:
                     r_list.remove(r)
 
+        self.finish()
+
+    def handle_traces(self):
+        # Drain every trace already queued before going back to select
+        while True:
+            reason = self.handle_trace()
+            if reason is None or not self.trace_pending():
+                self.flush_credits()
+                return reason
+
+    def trace_buffered(self):
+        return self.trace_buffer_start != self.trace_buffer_end
+
+    def trace_pending(self):
+        if self.trace_buffered():
+            return True
+        try:
+            self.trace_socket.recv_into(
+                self.trace_buffer, 1, socket.MSG_PEEK | socket.MSG_DONTWAIT
+            )
+        except BlockingIOError:
+            return False
+        return True
+
+    def trace_recv(self, size):
+        # Returns a view of the next size bytes of the trace socket. Whatever
+        # else is already queued is read ahead, so several traces are usually
+        # received with a single syscall. The view is only valid until the
+        # next call.
+        buffer = self.trace_buffer
+        start = self.trace_buffer_start
+        end = self.trace_buffer_end
+
+        if end - start < size:
+            if start + size > len(buffer):
+                buffer[: end - start] = buffer[start:end]
+                start, end = 0, end - start
+            # The plugin may be waiting on credits before it can send more
+            self.flush_credits()
+            while end - start < size:
+                num_bytes = self.trace_socket.recv_into(buffer[end:])
+                if not num_bytes:
+                    self.trace_buffer_start = self.trace_buffer_end = 0
+                    return
+                end += num_bytes
+
+        self.trace_buffer_start = start + size
+        self.trace_buffer_end = end
+        return buffer[start : start + size]
+
     def handle_trace(self):
-        trace_header_size = ctypes.sizeof(TRACE_HEADER)
-        trace_header = TRACE_HEADER.from_buffer(bytearray(trace_header_size))
-        if not self.trace_socket.recv_into(trace_header, flags=socket.MSG_WAITALL):
+        if self.trace_ring is not None:
+            return self.handle_trace_ring()
+
+        header_size = TRACE_HEADER_STRUCT.size
+        header_data = self.trace_recv(header_size)
+        if header_data is None:
             return
+        trace_header = TraceHeader.unpack_from(header_data)
 
-        bb_addr_type = dict(TRACE._fields_)["bb_addrs"]._type_
-        bb_addr_size = ctypes.sizeof(bb_addr_type)
+        data = self.trace_recv(trace_header.num_bytes)
+        self.handle_trace_payload(trace_header, data, 0)
 
-        num_addrs = trace_header.num_addrs
-        if self._skip_breakpoint_trace_address:
-            # GDB breakpoints will extraneously add an additional trace address
-            # See https://github.com/ConnorNelson/qtrace/issues/6
-            self.trace_socket.recv(bb_addr_size, socket.MSG_WAITALL)
-            num_addrs -= 1
-            self._skip_breakpoint_trace_address = False
+        return self.handle_trace_reason(trace_header)
+
+    def handle_trace_ring(self):
+        doorbell = self.trace_recv(8)
+        if doorbell is None:
+            return
+
+        ring_header = self.trace_ring_header
+        tail = ring_header.tail
+        assert int.from_bytes(doorbell, "little") == tail
+
+        slot_offset = self.trace_ring_slot()
+        trace_header = TraceHeader.unpack_from(self.trace_ring, slot_offset)
 
-        bb_addr_array_type = num_addrs * bb_addr_type
-        bb_addr_array_size = num_addrs * bb_addr_size
+        # The payload is handed out without copying, so it is only valid
+        # until the slot is released back to the plugin.
+        bb_addrs_offset = slot_offset + TRACE_HEADER_STRUCT.size
+        self.handle_trace_payload(trace_header, self.trace_ring, bb_addrs_offset)
 
-        bb_addrs = bb_addr_array_type.from_buffer(bytearray(bb_addr_array_size))
-        self.trace_socket.recv_into(bb_addrs, flags=socket.MSG_WAITALL)
+        ring_header.tail = tail + 1
 
-        self.on_basic_blocks(bb_addrs)
+        return self.handle_trace_reason(trace_header)
 
+    def trace_ring_slot(self):
+        # Offset of the slot the next doorbell rings for
+        ring_header = self.trace_ring_header
+        return TRACE_RING_SIZE + (ring_header.tail % ring_header.num_slots) * TRACE_SIZE
+
+    def handle_trace_payload(self, trace_header, buffer, offset):
+        num_addrs = trace_header.num_addrs
+        num_bytes = trace_header.num_bytes
+        data = memoryview(buffer)[offset : offset + num_bytes].toreadonly()
+        self.trace_sequence += 1
+
+        if trace_header.reason == TRACE_REASON.trace_counts.value:
+            self.on_basic_block_counts(data.cast("Q"))
+            return
+
+        if trace_header.encoding == TRACE_ENCODING.encoding_delta.value:
+            bb_addrs = memoryview(decode_deltas(data)).toreadonly()
+        else:
+            bb_addrs = data.cast("Q")
+
+        # GDB breakpoints will extraneously add an additional trace address
+        # See https://github.com/ConnorNelson/qtrace/issues/6
+        if not trace_header.num_records:
+            if self._skip_breakpoint_trace_address and num_addrs:
+                bb_addrs = bb_addrs[1:]
+                self._skip_breakpoint_trace_address = False
+            if not self.rle:
+                self.on_basic_block_batch(bb_addrs, self.trace_sequence)
+            else:
+                self.on_basic_block_runs([(bb_addrs, 1)])
+        else:
+            runs = []
+            for kind, words in split_records(bb_addrs):
+                if kind is None:
+                    run = (words, 1)
+                elif kind == TRACE_RECORD.record_run.value:
+                    repeats, *addresses = words
+                    run = (addresses, repeats)
+                else:
+                    # Syscall records go between the blocks around them
+                    if runs:
+                        self.on_basic_block_runs(runs)
+                        runs = []
+                    self.handle_record(kind, words)
+                    continue
+                # The extraneous address follows any leading records
+                if self._skip_breakpoint_trace_address:
+                    runs.extend(skip_first_address(*run))
+                    self._skip_breakpoint_trace_address = False
+                else:
+                    runs.append(run)
+            if runs:
+                self.on_basic_block_runs(runs)
+
+    def handle_record(self, kind, words):
+        syscall_nr = words[0]
+        filtered = not self.syscall_selected(syscall_nr)
+
+        if kind == TRACE_RECORD.record_syscall_start.value:
+            num_args = SYSCALL_NUM_ARGS.get(syscall_nr, SYSCALL_MAX_ARGS)
+            args = words[1 : 1 + num_args]
+            if filtered:
+                self.on_filtered_syscall(("syscall_start", syscall_nr, *args))
+            else:
+                self.on_syscall_start(syscall_nr, *args)
+
+        elif kind == TRACE_RECORD.record_syscall_end.value:
+            ret = signed(words[1])
+            if filtered:
+                self.on_filtered_syscall(("syscall_end", syscall_nr, ret))
+            else:
+                self.on_syscall_end(syscall_nr, ret)
+
+    def syscall_selected(self, syscall_nr):
+        allowlist = self.syscall_allowlist
+        if allowlist is not None and syscall_nr not in allowlist:
+            return False
+        denylist = self.syscall_denylist
+        if denylist is not None and syscall_nr in denylist:
+            return False
+        return True
+
+    def handle_trace_reason(self, trace_header):
         reason = TRACE_REASON(trace_header.reason)
 
         if reason == TRACE_REASON.trace_full:
-            self.ack()
+            self.credit()
 
         elif reason == TRACE_REASON.trace_syscall_start:
-            syscall_nr = trace_header.info.syscall_num
-            syscall_definition = syscalls["x86_64"][syscall_nr]
-            syscall_args = syscall_definition[2:]
-            args = list(trace_header.info.syscall_data.syscall_start_data)[
-                : len(syscall_args)
-            ]
-            self.on_syscall_start(syscall_nr, *args)
+            syscall_nr = trace_header.syscall_num
+            num_args = SYSCALL_NUM_ARGS.get(syscall_nr, SYSCALL_MAX_ARGS)
+            self.on_syscall_start(syscall_nr, *trace_header.syscall_data[:num_args])
+            self.ack()
 
         elif reason == TRACE_REASON.trace_syscall_end:
-            syscall_nr = trace_header.info.syscall_num
-            ret = trace_header.info.syscall_data.syscall_ret
+            syscall_nr = trace_header.syscall_num
+            ret = signed(trace_header.syscall_data[0])
             self.on_syscall_end(syscall_nr, ret)
+            self.ack()
 
         elif reason == TRACE_REASON.trace_async:
             self.ack()
 
+        elif reason == TRACE_REASON.trace_maps:
+            map_data = self.trace_recv(self.trace_data_size(trace_header))
+            self.handle_maps(bytes(map_data))
+            self.ack()
+
+        elif reason == TRACE_REASON.trace_counts:
+            self.ack()
+
+        elif reason == TRACE_REASON.trace_guest_base:
+            self.guest_base = trace_header.syscall_data[0]
+            self.credit()
+
+        elif reason == TRACE_REASON.trace_breakpoint:
+            registers = self.trace_recv(self.trace_data_size(trace_header))
+            registers = Registers._make(REGISTERS_STRUCT.unpack(registers))
+            index = trace_header.syscall_data[0]
+            # Without maps, the binary's base is where the breakpoint hit is
+            offset = self._breakpoint_callbacks[index].gdb_breakpoint_address
+            self._binary_base = registers.rip - offset
+            self.handle_breakpoint(index, registers)
+
+        elif reason == TRACE_REASON.trace_breakpoint_hits:
+            # Plugin breakpoints are counted by the plugin, in offset order
+            hits = self.trace_recv(self.trace_data_size(trace_header)).cast("Q")
+            for callback, count in zip(self._breakpoint_callbacks, hits):
+                self.breakpoint_hits[callback.__name__] = count
+            self.ack()
+
         return reason
 
+    def trace_data_size(self, trace_header):
+        # Some traces are followed by data on the trace socket
+        reason = TRACE_REASON(trace_header.reason)
+        if reason == TRACE_REASON.trace_maps:
+            return trace_header.syscall_data[0]
+        elif reason == TRACE_REASON.trace_breakpoint:
+            return REGISTERS_STRUCT.size
+        elif reason == TRACE_REASON.trace_breakpoint_hits:
+            return 8 * len(self._breakpoint_callbacks)
+        return 0
+
+    def handle_trace_until(self, reason):
+        # Traces sent before the requested one may still be queued
+        while True:
+            current_reason = self.handle_trace()
+            if current_reason == reason:
+                self.flush_credits()
+                return
+            if current_reason is None:
+                raise EOFError(f"Trace closed while waiting for {reason}")
+
     def ack(self):
-        os.write(self.trace_socket.fileno(), (0).to_bytes(8, "little"))
+        credits = RESPONSE_CREDIT * self.pending_credits
+        os.write(self.trace_socket.fileno(), credits + RESPONSE_ACK)
+        self.pending_credits = 0
+
+    def credit(self):
+        # Credits are batched until the plugin could be waiting on them
+        self.pending_credits += 1
+
+    def flush_credits(self):
+        if self.pending_credits:
+            credits = RESPONSE_CREDIT * self.pending_credits
+            os.write(self.trace_socket.fileno(), credits)
+            self.pending_credits = 0
 
     def request_flush(self):
         os.write(self.trace_socket.fileno(), (1).to_bytes(8, "little"))
-        reason = self.handle_trace()
-        assert reason == TRACE_REASON.trace_async
+        self.handle_trace_until(TRACE_REASON.trace_async)
 
     def request_maps(self):
         os.write(self.trace_socket.fileno(), (2).to_bytes(8, "little"))
 
     def update_maps(self):
         self.request_maps()
-        self.maps.clear()
+        self.handle_trace_until(TRACE_REASON.trace_maps)
 
-        map_data = b""
-        while not map_data.endswith(b"\n\n"):
-            map_data += self.trace_socket.recv(0x10000)
+    def handle_maps(self, map_data):
+        self.maps.clear()
 
         expected_range = range(0x4000000000, 0x5000000000)
         expected_pathnames = {self.argv[0], "[heap]", "[stack]"}
@@ -279,24 +863,49 @@ class TraceMachine:
                 mapping = (pathname, offset, permissions)
                 self.maps[(start_address, end_address)] = mapping
 
-        self.ack()
+    def on_basic_block_batch(self, addresses, sequence):
+        # addresses is a read-only uint64 memoryview of one trace, valid only
+        # during this call; sequence numbers the traces received
+        self.on_basic_blocks(addresses)
 
     def on_basic_blocks(self, addresses):
-        self.trace.extend(("bb", address) for address in addresses)
+        self.trace.extend_basic_blocks(addresses)
+
+    def on_basic_block_runs(self, runs):
+        # Each run is a sequence of addresses executed count times in a row
+        if len(runs) == 1 and runs[0][1] == 1:
+            addresses = runs[0][0]
+        else:
+            addresses = array.array("Q")
+            for run_addresses, count in runs:
+                addresses += array.array("Q", run_addresses) * count
+            addresses = memoryview(addresses).toreadonly()
+        self.on_basic_block_batch(addresses, self.trace_sequence)
+
+    def on_basic_block_counts(self, counts):
+        # Counts are cumulative (address, count) pairs
+        counts = iter(counts)
+        self.bb_counts.update(zip(counts, counts))
 
     def on_syscall_start(self, syscall_nr, *args):
+        # With synchronous_syscalls, the target waits until this returns
         self.trace.append(("syscall_start", syscall_nr, *args))
-        self.ack()
 
     def on_syscall_end(self, syscall_nr, ret):
         self.trace.append(("syscall_end", syscall_nr, ret))
-        self.ack()
+
+    def on_filtered_syscall(self, event):
+        # Filtered syscalls were not stopped at, so there is nothing to ack
+        self.trace.append(event)
 
     def on_output(self, fd, data):
         self.trace.append(("output", fd, data))
 
     def filtered_trace(self, filter_):
         if isinstance(filter_, str):
+            if isinstance(self.trace, (Trace, TraceWriter, TraceFile)):
+                yield from self.trace.filter(filter_)
+                return
             filter_str = filter_
             filter_ = lambda event: event[0] == filter_str
         yield from (event for event in self.trace if filter_(event))
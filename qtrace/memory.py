@@ -0,0 +1,98 @@
+import os
+import ctypes
+
+from .utils import libc
+
+
+IOV_MAX = 1024
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+libc.process_vm_readv.restype = ctypes.c_ssize_t
+libc.process_vm_readv.argtypes = [
+    ctypes.c_int,
+    ctypes.POINTER(iovec),
+    ctypes.c_ulong,
+    ctypes.POINTER(iovec),
+    ctypes.c_ulong,
+    ctypes.c_ulong,
+]
+
+
+class ProcessMemory:
+    # Guest memory of a linux-user QEMU process, accessed directly instead of
+    # through the gdbstub. Guest addresses are offset by guest_base in QEMU's
+    # own address space.
+    def __init__(self, pid, guest_base=0):
+        self.pid = pid
+        self.guest_base = guest_base
+        self.mem_fd = None
+
+    def close(self):
+        if self.mem_fd is not None:
+            os.close(self.mem_fd)
+            self.mem_fd = None
+
+    def read(self, address, length):
+        return self.read_regions([(address, length)])[0]
+
+    def read_regions(self, regions):
+        # Reads every (address, length) region with as few syscalls as
+        # process_vm_readv allows
+        regions = list(regions)
+        buffers = [bytearray(length) for _, length in regions]
+        for start in range(0, len(regions), IOV_MAX):
+            end = start + IOV_MAX
+            self.readv(regions[start:end], buffers[start:end])
+        return [bytes(buffer) for buffer in buffers]
+
+    def readv(self, regions, buffers):
+        local = (iovec * len(regions))()
+        remote = (iovec * len(regions))()
+        for i, ((address, length), buffer) in enumerate(zip(regions, buffers)):
+            if length:
+                local[i].iov_base = ctypes.addressof(
+                    (ctypes.c_char * length).from_buffer(buffer)
+                )
+            local[i].iov_len = length
+            remote[i].iov_base = address + self.guest_base
+            remote[i].iov_len = length
+
+        expected = sum(length for _, length in regions)
+        num_bytes = libc.process_vm_readv(
+            self.pid, local, len(regions), remote, len(regions), 0
+        )
+        if num_bytes < 0:
+            raise OSError(ctypes.get_errno(), "Failed to read guest memory")
+        if num_bytes != expected:
+            # Reads stop at the first region that is not fully mapped
+            for address, length in regions:
+                if num_bytes < length:
+                    address += num_bytes
+                    raise OSError(f"Failed to read guest memory at {address:#x}")
+                num_bytes -= length
+
+    def write(self, address, data):
+        # process_vm_writev cannot write to read-only mappings, unlike
+        # /proc/<pid>/mem
+        if self.mem_fd is None:
+            self.mem_fd = os.open(f"/proc/{self.pid}/mem", os.O_RDWR | os.O_CLOEXEC)
+        num_bytes = os.pwrite(self.mem_fd, data, address + self.guest_base)
+        if num_bytes != len(data):
+            raise OSError(f"Failed to write guest memory at {address + num_bytes:#x}")
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.step is None:
+            return self.read(key.start, key.stop - key.start)
+        raise KeyError()
+
+    def __setitem__(self, key, data):
+        if isinstance(key, slice) and key.step is None:
+            if len(data) != key.stop - key.start:
+                raise ValueError("Data does not fit the memory region")
+            self.write(key.start, data)
+            return
+        raise KeyError()
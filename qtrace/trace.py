@@ -0,0 +1,156 @@
+import array
+import itertools
+import collections
+
+
+BB = 0
+SYSCALL_START = 1
+SYSCALL_END = 2
+OUTPUT = 3
+OBJECT = 4
+
+EVENT_KINDS = ["bb", "syscall_start", "syscall_end", "output"]
+EVENT_KIND_CODES = {kind: code for code, kind in enumerate(EVENT_KINDS)}
+
+VALUE_MASK = 0xFFFFFFFFFFFFFFFF
+BB_SELECTORS = bytes([1] + [0] * 0xFF)
+
+
+def signed(value):
+    return value - ((value >> 63) << 64)
+
+
+class Trace:
+    # Events are stored column-wise: one byte of kind and one word of value
+    # per event. Basic block events store their address as the value, other
+    # events store an offset into one of the side tables. The positions of
+    # every event other than basic blocks are indexed by kind.
+    def __init__(self, events=()):
+        self.kinds = array.array("B")
+        self.values = array.array("Q")
+        self.args = array.array("Q")
+        self.outputs = []
+        self.objects = []
+        self.num_basic_blocks = 0
+        self.positions = collections.defaultdict(lambda: array.array("Q"))
+        self.extend(events)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        return itertools.starmap(self.event, zip(self.kinds, self.values))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            indices = range(len(self))[key]
+            return [self.event(self.kinds[i], self.values[i]) for i in indices]
+        index = range(len(self))[key]
+        return self.event(self.kinds[index], self.values[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, (Trace, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return f"<Trace: {len(self)} events>"
+
+    @property
+    def nbytes(self):
+        columns = [self.kinds, self.values, self.args]
+        return sum(column.itemsize * len(column) for column in columns)
+
+    def event(self, code, value):
+        if code == BB:
+            return ("bb", value)
+        elif code == SYSCALL_START:
+            syscall_nr, num_args = self.args[value : value + 2]
+            args = self.args[value + 2 : value + 2 + num_args]
+            return ("syscall_start", syscall_nr, *args)
+        elif code == SYSCALL_END:
+            syscall_nr, ret = self.args[value : value + 2]
+            return ("syscall_end", syscall_nr, signed(ret))
+        elif code == OUTPUT:
+            return ("output", *self.outputs[value])
+        else:
+            return self.objects[value]
+
+    def append(self, event):
+        kind, *fields = event
+        code = EVENT_KIND_CODES.get(kind, OBJECT)
+
+        if code == BB:
+            (value,) = fields
+        elif code == SYSCALL_START:
+            syscall_nr, *args = fields
+            value = len(self.args)
+            self.args.extend([syscall_nr, len(args), *(arg & VALUE_MASK for arg in args)])
+        elif code == SYSCALL_END:
+            syscall_nr, ret = fields
+            value = len(self.args)
+            self.args.extend([syscall_nr, ret & VALUE_MASK])
+        elif code == OUTPUT:
+            fd, data = fields
+            value = len(self.outputs)
+            self.outputs.append((fd, data))
+        else:
+            value = len(self.objects)
+            self.objects.append(tuple(event))
+
+        if code == BB:
+            self.num_basic_blocks += 1
+        else:
+            self.positions[kind].append(len(self.kinds))
+        self.kinds.append(code)
+        self.values.append(value)
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def extend_basic_blocks(self, addresses):
+        num_values = len(self.values)
+        try:
+            self.values.frombytes(memoryview(addresses).cast("B"))
+        except TypeError:
+            self.values.extend(addresses)
+        self.kinds.frombytes(bytes(len(self.values) - num_values))
+        self.num_basic_blocks += len(self.values) - num_values
+
+    def reindex(self):
+        kinds = self.kinds.tobytes()
+        self.num_basic_blocks = kinds.count(BB)
+        self.positions.clear()
+        for code in [SYSCALL_START, SYSCALL_END, OUTPUT, OBJECT]:
+            position = kinds.find(code)
+            while position != -1:
+                if code == OBJECT:
+                    kind = self.objects[self.values[position]][0]
+                else:
+                    kind = EVENT_KINDS[code]
+                self.positions[kind].append(position)
+                position = kinds.find(code, position + 1)
+
+    def num_events(self, kind):
+        if kind == "bb":
+            return self.num_basic_blocks
+        return len(self.positions.get(kind, ()))
+
+    def addresses(self):
+        selectors = self.kinds.tobytes().translate(BB_SELECTORS)
+        return array.array("Q", itertools.compress(self.values, selectors))
+
+    def filter(self, kind):
+        if kind == "bb":
+            yield from (("bb", address) for address in self.addresses())
+            return
+        for position in self.positions.get(kind, ()):
+            yield self.event(self.kinds[position], self.values[position])
+
+    def numpy(self):
+        import numpy
+
+        kinds = numpy.frombuffer(self.kinds, dtype=numpy.uint8)
+        values = numpy.frombuffer(self.values, dtype=numpy.uint64)
+        return kinds, values
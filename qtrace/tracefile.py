@@ -0,0 +1,354 @@
+import os
+import abc
+import mmap
+import json
+import array
+import bisect
+import ctypes
+
+from .trace import EVENT_KINDS, EVENT_KIND_CODES, OBJECT, Trace
+
+
+TRACE_FILE_MAGIC = b"QTRACE02"
+TRACE_FILE_CHUNK_EVENTS = 0x100000
+
+
+class CHUNK_HEADER(ctypes.Structure):
+    _fields_ = [
+        ("num_events", ctypes.c_uint64),
+        ("num_args", ctypes.c_uint64),
+        ("num_outputs", ctypes.c_uint64),
+        ("outputs_size", ctypes.c_uint64),
+        ("objects_size", ctypes.c_uint64),
+        ("kind_counts", ctypes.c_uint64 * (OBJECT + 1)),
+    ]
+
+
+class TRAILER(ctypes.Structure):
+    _fields_ = [
+        ("index_offset", ctypes.c_uint64),
+        ("num_chunks", ctypes.c_uint64),
+        ("magic", ctypes.c_char * 8),
+    ]
+
+
+def padding(size):
+    return -size % 8
+
+
+def encode_object(value):
+    # Object events are stored as JSON, with tuples and bytes tagged so they
+    # read back as they were appended
+    if isinstance(value, tuple):
+        return {"tuple": [encode_object(item) for item in value]}
+    if isinstance(value, list):
+        return [encode_object(item) for item in value]
+    if isinstance(value, dict):
+        items = value.items()
+        return {"dict": [[encode_object(k), encode_object(v)] for k, v in items]}
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": bytes(value).hex()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"Cannot write {type(value).__name__} to a trace file")
+
+
+def decode_object(value):
+    if isinstance(value, list):
+        return [decode_object(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    ((tag, items),) = value.items()
+    if tag == "tuple":
+        return tuple(decode_object(item) for item in items)
+    if tag == "dict":
+        return {decode_object(k): decode_object(v) for k, v in items}
+    return bytes.fromhex(items)
+
+
+def chunk_size(header):
+    return (
+        ctypes.sizeof(CHUNK_HEADER)
+        + header.num_events
+        + padding(header.num_events)
+        + header.num_events * 8
+        + header.num_args * 8
+        + header.num_outputs * 16
+        + header.outputs_size
+        + padding(header.outputs_size)
+        + header.objects_size
+        + padding(header.objects_size)
+    )
+
+
+def read_chunk(data, offset):
+    header = CHUNK_HEADER.from_buffer_copy(data, offset)
+    offset += ctypes.sizeof(CHUNK_HEADER)
+
+    chunk = Trace()
+    output_sizes = array.array("Q")
+    for column, size in [
+        (chunk.kinds, header.num_events),
+        (chunk.values, header.num_events * 8),
+        (chunk.args, header.num_args * 8),
+        (output_sizes, header.num_outputs * 16),
+    ]:
+        column.frombytes(data[offset : offset + size])
+        offset += size + padding(size)
+
+    # Outputs are (fd, size) pairs followed by all of their data
+    for fd, size in zip(output_sizes[::2], output_sizes[1::2]):
+        chunk.outputs.append((fd, bytes(data[offset : offset + size])))
+        offset += size
+    offset += padding(header.outputs_size)
+
+    objects = json.loads(bytes(data[offset : offset + header.objects_size]))
+    chunk.objects = [decode_object(event) for event in objects]
+    chunk.reindex()
+    return chunk
+
+
+class TraceChunks(abc.ABC):
+    # Read access to a trace stored in chunks, each a Trace. Subclasses set
+    # starts, where starts[i] is the first event of chunk i followed by the
+    # total number of events, and headers, where headers[i] counts chunk i's
+    # events by kind, and read chunks with chunk.
+    def __len__(self):
+        return self.starts[-1]
+
+    def __iter__(self):
+        for chunk_index in range(self.num_chunks):
+            yield from self.chunk(chunk_index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[index] for index in range(len(self))[key]]
+        index = range(len(self))[key]
+        chunk_index = bisect.bisect_right(self.starts, index) - 1
+        return self.chunk(chunk_index)[index - self.starts[chunk_index]]
+
+    @property
+    def num_chunks(self):
+        return len(self.starts) - 1
+
+    @abc.abstractmethod
+    def chunk(self, chunk_index):
+        pass
+
+    def address_chunks(self):
+        for chunk_index in range(self.num_chunks):
+            yield self.chunk(chunk_index).addresses()
+
+    def matching_chunks(self, kind):
+        # Chunk headers count each kind, so chunks without any are skipped
+        code = EVENT_KIND_CODES.get(kind, OBJECT)
+        for chunk_index, header in enumerate(self.headers):
+            if header.kind_counts[code]:
+                yield chunk_index
+
+    def num_events(self, kind):
+        if kind in EVENT_KIND_CODES:
+            code = EVENT_KIND_CODES[kind]
+            return sum(header.kind_counts[code] for header in self.headers)
+        return sum(
+            self.chunk(chunk_index).num_events(kind)
+            for chunk_index in self.matching_chunks(kind)
+        )
+
+    def filter(self, kind):
+        for chunk_index in self.matching_chunks(kind):
+            yield from self.chunk(chunk_index).filter(kind)
+
+
+class TraceWriter(TraceChunks):
+    # The file is a magic, then chunks of serialized Trace columns, then an
+    # index of (chunk offset, num events) pairs and a trailer locating it.
+    # Events can be read back while writing, the pending ones from memory.
+    def __init__(self, path, *, chunk_events=TRACE_FILE_CHUNK_EVENTS):
+        self.path = path
+        self.chunk_events = chunk_events
+        self.file = open(path, "w+b")
+        self.file.write(TRACE_FILE_MAGIC)
+        self.pending = Trace()
+        self.offsets = []
+        self.starts = [0]
+        self.headers = []
+        self.cached_chunk = (None, None)
+
+    def __len__(self):
+        return self.starts[-1] + len(self.pending)
+
+    def __iter__(self):
+        yield from super().__iter__()
+        yield from self.pending
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[index] for index in range(len(self))[key]]
+        index = range(len(self))[key]
+        if index >= self.starts[-1]:
+            return self.pending[index - self.starts[-1]]
+        return super().__getitem__(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, event):
+        self.pending.append(event)
+        self.maybe_write_chunk()
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    def extend_basic_blocks(self, addresses):
+        self.pending.extend_basic_blocks(addresses)
+        self.maybe_write_chunk()
+
+    def maybe_write_chunk(self):
+        if len(self.pending) >= self.chunk_events:
+            self.write_chunk()
+
+    def write_chunk(self):
+        chunk = self.pending
+        if not len(chunk):
+            return
+
+        output_sizes = array.array("Q")
+        for fd, data in chunk.outputs:
+            output_sizes.extend([fd, len(data)])
+        outputs = b"".join(data for fd, data in chunk.outputs)
+        objects = json.dumps([encode_object(event) for event in chunk.objects]).encode()
+        header = CHUNK_HEADER(
+            num_events=len(chunk),
+            num_args=len(chunk.args),
+            num_outputs=len(chunk.outputs),
+            outputs_size=len(outputs),
+            objects_size=len(objects),
+        )
+        for code, kind in enumerate(EVENT_KINDS):
+            header.kind_counts[code] = chunk.num_events(kind)
+        header.kind_counts[OBJECT] = len(chunk.objects)
+
+        self.offsets.append(self.file.tell())
+        self.file.write(header)
+        self.file.write(chunk.kinds)
+        self.file.write(bytes(padding(len(chunk.kinds))))
+        self.file.write(chunk.values)
+        self.file.write(chunk.args)
+        self.file.write(output_sizes)
+        self.file.write(outputs)
+        self.file.write(bytes(padding(len(outputs))))
+        self.file.write(objects)
+        self.file.write(bytes(padding(len(objects))))
+
+        self.starts.append(self.starts[-1] + len(chunk))
+        self.headers.append(header)
+        self.pending = Trace()
+
+    def chunk(self, chunk_index):
+        # Written chunks are read back from the file
+        cached_index, cached_chunk = self.cached_chunk
+        if cached_index == chunk_index:
+            return cached_chunk
+
+        self.file.flush()
+        size = chunk_size(self.headers[chunk_index])
+        data = os.pread(self.file.fileno(), size, self.offsets[chunk_index])
+        chunk = read_chunk(data, 0)
+
+        self.cached_chunk = (chunk_index, chunk)
+        return chunk
+
+    def num_events(self, kind):
+        return super().num_events(kind) + self.pending.num_events(kind)
+
+    def filter(self, kind):
+        yield from super().filter(kind)
+        yield from self.pending.filter(kind)
+
+    def flush(self):
+        self.write_chunk()
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.write_chunk()
+        index = array.array("Q")
+        for chunk_index, offset in enumerate(self.offsets):
+            num_events = self.starts[chunk_index + 1] - self.starts[chunk_index]
+            index.extend([offset, num_events])
+        trailer = TRAILER(
+            index_offset=self.file.tell(),
+            num_chunks=len(self.offsets),
+            magic=TRACE_FILE_MAGIC,
+        )
+        self.file.write(index)
+        self.file.write(trailer)
+        self.file.close()
+
+
+class TraceFile(TraceChunks):
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[: len(TRACE_FILE_MAGIC)] != TRACE_FILE_MAGIC:
+            raise ValueError(f"Not a trace file: {path}")
+
+        self.offsets, self.starts = self.read_index()
+        self.headers = [
+            CHUNK_HEADER.from_buffer_copy(self.data, offset) for offset in self.offsets
+        ]
+        self.cached_chunk = (None, None)
+
+    def read_index(self):
+        trailer_offset = len(self.data) - ctypes.sizeof(TRAILER)
+        if trailer_offset >= len(TRACE_FILE_MAGIC):
+            trailer = TRAILER.from_buffer_copy(self.data, trailer_offset)
+        else:
+            trailer = None
+
+        offsets = []
+        starts = [0]
+        if trailer is not None and trailer.magic == TRACE_FILE_MAGIC:
+            index = array.array("Q")
+            index.frombytes(self.data[trailer.index_offset : trailer_offset])
+            for offset, num_events in zip(index[::2], index[1::2]):
+                offsets.append(offset)
+                starts.append(starts[-1] + num_events)
+        else:
+            # The writer never closed the file, recover the complete chunks
+            offset = len(TRACE_FILE_MAGIC)
+            while offset + ctypes.sizeof(CHUNK_HEADER) <= len(self.data):
+                header = CHUNK_HEADER.from_buffer_copy(self.data, offset)
+                size = chunk_size(header)
+                if offset + size > len(self.data):
+                    break
+                offsets.append(offset)
+                starts.append(starts[-1] + header.num_events)
+                offset += size
+        return offsets, starts
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def chunk(self, chunk_index):
+        cached_index, cached_chunk = self.cached_chunk
+        if cached_index == chunk_index:
+            return cached_chunk
+
+        chunk = read_chunk(self.data, self.offsets[chunk_index])
+
+        self.cached_chunk = (chunk_index, chunk)
+        return chunk
@@ -1,12 +1,102 @@
+import os
 import time
+import errno
 import socket
+import select
+import ctypes
+import pathlib
+import threading
 import contextlib
 
 
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+libc = ctypes.CDLL(None, use_errno=True)
+thread_inotify_instances = threading.local()
+
+
 def create_connection(address, *, num_attempts=4096, sleep_time=0.001):
+    # Addresses are either (host, port) pairs or Unix socket paths
+    if not isinstance(address, tuple):
+        wait_for_path(address, timeout=num_attempts * sleep_time)
     for _ in range(num_attempts):
         with contextlib.suppress(ConnectionRefusedError, OSError):
-            return socket.create_connection(address)
+            if isinstance(address, tuple):
+                return socket.create_connection(address)
+            return create_unix_connection(address)
         time.sleep(sleep_time)
     else:
         raise ConnectionRefusedError()
+
+
+def create_unix_connection(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def wait_for_path(path, *, timeout=None):
+    # Sleeps until path is created, woken by inotify instead of polling
+    path = pathlib.Path(path)
+    inotify_fd = thread_inotify().fd
+
+    watch = libc.inotify_add_watch(
+        inotify_fd, bytes(path.parent), IN_CREATE | IN_MOVED_TO
+    )
+    if watch < 0:
+        raise OSError(ctypes.get_errno(), f"Could not watch {path.parent}")
+
+    try:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not path.exists():
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(errno.ETIMEDOUT, f"Timed out waiting for {path}")
+            if select.select([inotify_fd], [], [], remaining)[0]:
+                with contextlib.suppress(BlockingIOError):
+                    os.read(inotify_fd, 0x1000)
+    finally:
+        libc.inotify_rm_watch(inotify_fd, watch)
+
+
+class Inotify:
+    # An inotify instance, closed when leaving its with block or once it is
+    # no longer referenced
+    def __init__(self):
+        self.fd = None
+        fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def thread_inotify():
+    # Closing an inotify instance that had watches waits for an RCU grace
+    # period, which takes milliseconds, so each thread keeps one open and only
+    # removes watches. It is closed along with the thread's locals when the
+    # thread exits.
+    inotify = getattr(thread_inotify_instances, "inotify", None)
+    if inotify is None:
+        inotify = thread_inotify_instances.inotify = Inotify()
+    return inotify
@@ -0,0 +1,15 @@
+#include <unistd.h>
+#include <sys/syscall.h>
+
+
+int main()
+{
+    /*
+     * A varying number of blocks between syscalls, so their records land at
+     * every position of the plugin's per-vCPU buffer
+     */
+    for (volatile int i = 0; i < 0x1000; i++) {
+        for (volatile int j = 0; j < i % 61; j++);
+        syscall(SYS_getpid);
+    }
+}
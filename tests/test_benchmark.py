@@ -0,0 +1,128 @@
+import gc
+import os
+import time
+import socket
+import pathlib
+import threading
+
+import qtrace
+
+
+programs_dir = pathlib.Path(__file__).parent / "programs"
+
+
+def test_loop_bb_throughput():
+    class CountingMachine(qtrace.TraceMachine):
+        num_bbs = 0
+
+        def on_basic_blocks(self, addresses):
+            self.num_bbs += len(addresses)
+
+    loop_path = programs_dir / "loop"
+    machine = CountingMachine([loop_path])
+
+    start_time = time.perf_counter()
+    machine.run()
+    total_time = time.perf_counter() - start_time
+
+    print(f"{machine.num_bbs / total_time:.0f} basic blocks/s ({total_time:.4f}s)")
+    assert machine.num_bbs > 0x1000000
+
+
+def test_loop_encoding_throughput():
+    class ByteCountingMachine(qtrace.TraceMachine):
+        num_bbs = 0
+        num_bytes = 0
+
+        def handle_trace_payload(self, trace_header, buffer, offset):
+            if trace_header.reason != qtrace.machine.TRACE_REASON.trace_counts.value:
+                self.num_bbs += trace_header.num_addrs
+                self.num_bytes += trace_header.num_bytes
+            super().handle_trace_payload(trace_header, buffer, offset)
+
+        def on_basic_blocks(self, addresses):
+            pass
+
+    loop_path = programs_dir / "loop"
+    for encoding in ["raw", "delta"]:
+        machine = ByteCountingMachine([loop_path], encoding=encoding)
+
+        start_time = time.perf_counter()
+        machine.run()
+        total_time = time.perf_counter() - start_time
+
+        print(
+            f"{encoding}: {machine.num_bytes / machine.num_bbs:.2f} bytes/basic block, "
+            f"{machine.num_bbs / total_time:.0f} basic blocks/s ({total_time:.4f}s)"
+        )
+        assert machine.num_bbs > 0x1000000
+
+
+def test_handle_trace_cpu_time():
+    class CountingMachine(qtrace.TraceMachine):
+        num_bbs = 0
+
+        def on_basic_blocks(self, addresses):
+            self.num_bbs += len(addresses)
+
+    num_traces = 0x10000
+    trace_header = qtrace.machine.TRACE_HEADER(num_addrs=0x10, num_bytes=0x80)
+    trace_data = bytes(trace_header) + bytes(0x80)
+
+    machine = CountingMachine(["loop"], transport="socket")
+    machine.trace_socket, plugin_socket = socket.socketpair()
+
+    def plugin():
+        for _ in range(num_traces):
+            plugin_socket.sendall(trace_data)
+
+    def plugin_client():
+        while plugin_socket.recv(0x10000):
+            pass
+
+    threading.Thread(target=plugin, daemon=True).start()
+    threading.Thread(target=plugin_client, daemon=True).start()
+
+    start_time = time.thread_time()
+    while machine.num_bbs < num_traces * 0x10:
+        machine.handle_traces()
+    total_time = time.thread_time() - start_time
+
+    print(f"{total_time / num_traces * 1e6:.2f}us CPU time/trace")
+    assert machine.num_bbs == num_traces * 0x10
+
+
+def test_startup_latency(monkeypatch):
+    class TimedMachine(qtrace.TraceMachine):
+        def setup(self):
+            super().setup()
+            self.setup_time = time.perf_counter()
+
+    # Waiting on the gdbstub socket never polls
+    sleeps = []
+    monkeypatch.setattr(qtrace.utils.time, "sleep", sleeps.append)
+
+    num_runs = 0x10
+    setup_times = []
+    run_times = []
+    num_fds = []
+    for _ in range(num_runs):
+        machine = TimedMachine(["/bin/true"])
+        start_time = time.perf_counter()
+        machine.run()
+        setup_times.append(machine.setup_time - start_time)
+        run_times.append(time.perf_counter() - start_time)
+        del machine
+        gc.collect()
+        num_fds.append(len(os.listdir("/proc/self/fd")))
+
+    setup_times.sort()
+    run_times.sort()
+    print(
+        f"setup: {setup_times[num_runs // 2] * 1e3:.2f}ms median, "
+        f"{setup_times[-1] * 1e3:.2f}ms max; "
+        f"run: {run_times[num_runs // 2] * 1e3:.2f}ms median"
+    )
+    assert not sleeps
+    # The inotify instance is reused, and nothing else is left open either
+    assert len(set(num_fds)) == 1
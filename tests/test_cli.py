@@ -1,3 +1,4 @@
+import json
 import subprocess
 
 
@@ -9,3 +10,14 @@ def test_cli():
     assert any("basic blocks" in line for line in traced_lines)
     assert any("syscalls" in line for line in traced_lines)
     assert any("outputs" in line for line in traced_lines)
+
+
+def test_cli_batch():
+    jobs = '["true"]\n["false"]\n{"argv": ["cat"], "stdin": "hello"}\n'
+    output = subprocess.check_output(["qtrace", "batch", "-"], input=jobs.encode())
+    results = [json.loads(line) for line in output.decode().splitlines()]
+
+    assert len(results) == 3
+    assert all(result["status"] == "ok" for result in results)
+    assert all(result["num_bbs"] > 0 for result in results)
+    assert any(result["output_size"] == len("hello") for result in results)
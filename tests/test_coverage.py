@@ -0,0 +1,34 @@
+import pathlib
+
+import qtrace
+from qtrace.coverage import NO_NEW_COVERAGE, NEW_HIT_COUNTS, NEW_EDGES
+
+
+programs_dir = pathlib.Path(__file__).parent / "programs"
+
+
+def bitmap(hits):
+    edge_map = bytearray(qtrace.EDGE_MAP_SIZE)
+    for edge, count in hits.items():
+        edge_map[edge] = count
+    return qtrace.EdgeBitmap(edge_map)
+
+
+def test_coverage():
+    coverage = qtrace.Coverage()
+    assert coverage.update(bitmap({1: 1, 2: 3})) == NEW_EDGES
+    assert coverage.update(bitmap({1: 1, 2: 3})) == NO_NEW_COVERAGE
+    assert coverage.update(bitmap({2: 4})) == NEW_HIT_COUNTS
+    assert coverage.update(bitmap({2: 7})) == NO_NEW_COVERAGE
+    assert coverage.update(bitmap({3: 1})) == NEW_EDGES
+    assert coverage.num_edges == 3
+
+
+def test_loop_edges_mode():
+    loop_path = programs_dir / "loop"
+    machine = qtrace.TraceMachine([loop_path], mode="edges")
+    machine.run()
+
+    assert not list(machine.filtered_trace("bb"))
+    assert machine.edge_bitmap.num_edges > 0
+    assert qtrace.Coverage().update(machine.edge_bitmap) == NEW_EDGES
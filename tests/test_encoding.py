@@ -0,0 +1,24 @@
+import array
+
+from qtrace.encoding import RECORD_FLAG, encode_deltas, decode_deltas, split_records
+
+
+def test_delta_encoding():
+    addresses = [0x4000001130, 0x4000001138, 0x4000001130, 0x7FFFF7FD0100, 0, 1 << 63]
+    encoded = encode_deltas(addresses)
+    assert list(decode_deltas(encoded)) == addresses
+
+    loop_addresses = [0x4000001130, 0x4000001138] * 0x800
+    encoded = encode_deltas(loop_addresses)
+    assert len(encoded) < len(loop_addresses) + 8
+    assert list(decode_deltas(encoded)) == loop_addresses
+
+
+def test_split_records():
+    words = array.array("Q", [1, 2, RECORD_FLAG | 2, 5, 6, 3, RECORD_FLAG | (1 << 32) | 1, 7])
+    assert [(kind, list(record)) for kind, record in split_records(words)] == [
+        (None, [1, 2]),
+        (0, [5, 6]),
+        (None, [3]),
+        (1, [7]),
+    ]
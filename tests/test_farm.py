@@ -0,0 +1,16 @@
+from qtrace.farm import FarmMachine
+
+
+def test_summary_syscalls():
+    machine = FarmMachine(["true"])
+    machine.trace.extend(
+        [
+            ("syscall_start", 1, 1, 0x1000, 6),
+            ("syscall_start", 435, 0, 0),
+            ("syscall_start", 231, 0),
+        ]
+    )
+
+    # clone3 is newer than the syscall table
+    syscall_counts = machine.summary()["syscalls"]
+    assert syscall_counts == {"sys_write": 1, "syscall_435": 1, "sys_exit_group": 1}
@@ -0,0 +1,171 @@
+import socket
+import threading
+
+from qtrace.gdb.gdb_minimal_client import GDB, amd64, decode_packet
+
+
+def packet(data):
+    return b"$" + data + b"#" + f"{sum(data) % 256:02x}".encode()
+
+
+def fake_stub(path, replies):
+    # Answers each request with the next of replies, and returns the
+    # requests received, acks included
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(str(path))
+    server.listen(1)
+    received = []
+
+    def serve():
+        connection, _ = server.accept()
+        requests = b""
+        no_ack = False
+        for reply in replies:
+            while len(requests.partition(b"#")[2]) < 2:
+                data = connection.recv(0x1000)
+                received.append(data)
+                requests += data
+            request, _, requests = requests.partition(b"#")
+            requests = requests[2:]
+            connection.sendall(reply if no_ack else b"+" + reply)
+            if request.endswith(b"$QStartNoAckMode") and reply == packet(b"OK"):
+                no_ack = True
+        while connection.recv(0x1000):
+            pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    return received
+
+
+def test_decode_packet():
+    assert decode_packet(b"plain") == b"plain"
+    assert decode_packet(b"a}\x03b}]") == b"a#b}"
+    assert decode_packet(b"0* 1") == b"00001"
+
+
+def test_buffered_packets(tmp_path):
+    num_hex = len(amd64["regs"]) * 16
+    registers = b"01" + b"0" * (num_hex - 2)
+    # Run-length encode the zeros, which QEMU's stub may do for large replies
+    encoded = b"01"
+    remaining = num_hex - 2
+    while remaining:
+        run = min(remaining, 91)
+        encoded += b"0" if run == 1 else b"0*" + bytes([29 + run - 1])
+        remaining -= run
+    assert decode_packet(encoded) == registers
+
+    path = tmp_path / "gdb"
+    # Neither no-ack mode nor p are supported, so registers come from g
+    replies = [packet(b""), packet(b""), packet(encoded)]
+    replies.append(packet(b"S05") + packet(b"W00"))
+    fake_stub(path, replies)
+    gdb = GDB(str(path))
+    assert gdb.rax == 1
+    assert gdb.rip == 0
+
+    gdb.async_continue()
+    assert gdb.recv() == b"S05"
+    assert gdb.buffered()
+    assert gdb.recv() == b"W00"
+    assert not gdb.buffered()
+
+
+def test_no_ack_pipeline(tmp_path):
+    path = tmp_path / "gdb"
+    received = fake_stub(
+        path,
+        [packet(b"OK")] * 3 + [packet(b"b\x01\x02"), packet(b"b}\x03")],
+    )
+    gdb = GDB(str(path))
+    assert gdb.no_ack
+
+    gdb.add_breakpoints({0x1000: None, 0x2000: None})
+    assert gdb.fetch_memory_regions([(0x1000, 2), (0x2000, 1)]) == [b"\x01\x02", b"#"]
+
+    requests = b"".join(received)
+    # Only the reply to QStartNoAckMode itself is acked
+    assert requests.count(b"+") == 1
+    assert b"$Z0,1000,2#" in requests and b"$Z0,2000,2#" in requests
+
+
+def test_stop_cache(tmp_path):
+    memory = bytes(range(0x100)) * 0x10
+    path = tmp_path / "gdb"
+    received = fake_stub(
+        path,
+        [
+            packet(b"OK"),
+            packet(b"3412000000000000"),
+            packet(b"0700000000000000"),
+            # x is not supported, so memory is read in hex chunks with m
+            packet(b""),
+            packet(memory[:0x800].hex().encode()),
+            packet(memory[0x800:].hex().encode()),
+            packet(b"S05"),
+            packet(b"3512000000000000"),
+        ],
+    )
+    gdb = GDB(str(path))
+    assert gdb.rip == 0x1234
+    assert gdb["rdi"] == 7
+    assert gdb.rip == 0x1234
+
+    assert gdb.memory[0x1000:0x1004] == memory[:4]
+    assert gdb.memory[0x1004:0x1008] == memory[4:8]
+    assert gdb.memory[0x17FE:0x1802] == memory[0x7FE:0x802]
+
+    gdb.async_continue()
+    assert gdb.recv() == b"S05"
+    assert gdb.rip == 0x1235
+
+    requests = b"".join(received)
+    assert requests.count(b"$p10#") == 2
+    assert requests.count(b"$m1000,800#") == 1
+    assert requests.count(b"$m1800,800#") == 1
+
+
+def test_rsp_memory(tmp_path):
+    class Machine:
+        @property
+        def memory(self):
+            raise AssertionError("rsp_memory never reads the QEMU process")
+
+    memory = bytes(range(0x100)) * 8
+    escaped = b"".join(
+        b"}" + bytes([byte ^ 0x20]) if byte in b"#$*}" else bytes([byte])
+        for byte in memory
+    )
+    path = tmp_path / "gdb"
+    received = fake_stub(path, [packet(b"OK"), packet(b"b" + escaped)])
+    # Memory is read in binary chunks with x, cached while stopped
+    gdb = GDB(str(path), machine=Machine(), rsp_memory=True)
+    assert gdb.memory[0x1000:0x1004] == memory[:4]
+    assert gdb.memory[0x1010:0x1020] == memory[0x10:0x20]
+
+    requests = b"".join(received)
+    assert requests.count(b"$x1000,800#") == 1
+
+
+def test_repeated_breakpoint(tmp_path):
+    path = tmp_path / "gdb"
+    rip = packet((0x1000).to_bytes(8, "little").hex().encode())
+    received = fake_stub(
+        path,
+        [packet(b"OK"), packet(b"OK"), packet(b"S05"), rip]
+        + [packet(b"S05"), packet(b"S05"), rip]
+        + [packet(b"S05"), packet(b"W00")],
+    )
+    hits = []
+    gdb = GDB(str(path))
+    assert gdb.no_ack
+    gdb.add_breakpoint(0x1000, lambda: hits.append(gdb.rip))
+    gdb.async_continue()
+    while gdb.async_recv():
+        pass
+    assert hits == [0x1000, 0x1000]
+
+    # Each continue is sent only after the step before it stopped
+    for data in received:
+        assert not (b"$s#" in data and b"$c#" in data)
+    assert b"".join(received).count(b"$c#") == 3
@@ -1,4 +1,5 @@
 import pathlib
+import threading
 
 import qtrace
 
@@ -10,3 +11,61 @@ def test_loop():
     loop_path = programs_dir / "loop"
     machine = qtrace.TraceMachine([loop_path])
     machine.run()
+
+
+def test_loop_socket_transport():
+    loop_path = programs_dir / "loop"
+    machine = qtrace.TraceMachine([loop_path], transport="socket")
+    machine.run()
+
+
+def test_loop_count_mode():
+    loop_path = programs_dir / "loop"
+    machine = qtrace.TraceMachine([loop_path], mode="count")
+    machine.run()
+
+    assert not list(machine.filtered_trace("bb"))
+    assert max(machine.bb_counts.values()) >= 0x1000000
+
+
+def test_loop_rle():
+    loop_path = programs_dir / "loop"
+    machine = qtrace.TraceMachine([loop_path])
+    machine.run()
+    rle_machine = qtrace.TraceMachine([loop_path], rle=True)
+    rle_machine.run()
+
+    assert list(rle_machine.filtered_trace("bb")) == list(machine.filtered_trace("bb"))
+
+
+def test_loop_basic_block_batches():
+    sequences = []
+
+    class BatchMachine(qtrace.TraceMachine):
+        num_bbs = 0
+
+        def on_basic_block_batch(self, addresses, sequence):
+            assert addresses.readonly and addresses.format == "Q"
+            self.num_bbs += len(addresses)
+            sequences.append(sequence)
+
+    loop_path = programs_dir / "loop"
+    machine = BatchMachine([loop_path])
+    machine.run()
+
+    assert not list(machine.filtered_trace("bb"))
+    assert machine.num_bbs >= 0x1000000
+    assert sequences == sorted(set(sequences))
+
+
+def test_loop_concurrent():
+    loop_path = programs_dir / "loop"
+    machines = [qtrace.TraceMachine([loop_path]) for _ in range(4)]
+    threads = [threading.Thread(target=machine.run) for machine in machines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    num_bbs = [len(list(machine.filtered_trace("bb"))) for machine in machines]
+    assert len(set(num_bbs)) == 1 and num_bbs[0] >= 0x1000000
@@ -1,6 +1,10 @@
+import array
+import asyncio
 import subprocess
 import pathlib
 
+import pytest
+
 import qtrace
 
 
@@ -17,6 +21,18 @@ def symbol_address(program_path, symbol):
         raise Exception("Failed to find symbol")
 
 
+def instruction_addresses(program_path, symbol):
+    disassembly = subprocess.check_output(
+        ["objdump", "--disassemble=" + symbol, "--no-show-raw-insn", program_path]
+    )
+    addresses = []
+    for line in disassembly.decode().split("\n"):
+        address, _, instruction = line.strip().partition(":\t")
+        if instruction:
+            addresses.append(int(address, 16))
+    return addresses
+
+
 def test_machine():
     factorial_path = programs_dir / "factorial"
     factorial_address = symbol_address(factorial_path, "factorial")
@@ -43,3 +59,281 @@ def test_machine():
 
     factorial_args = [e[1]["rdi"] for e in machine.filtered_trace("test")]
     assert factorial_args == [7, 6, 5, 4, 3, 2, 1, 0]
+
+
+def test_async_machine(tmp_path):
+    factorial_path = programs_dir / "factorial"
+    factorial_address = symbol_address(factorial_path, "factorial")
+
+    class TestMachine(qtrace.AsyncTraceMachine):
+        @qtrace.breakpoint(factorial_address)
+        async def on_factorial(self):
+            await asyncio.sleep(0)
+            self.trace.append(("test", self.gdb.rdi))
+
+    async def trace_factorial(trace_path):
+        machine = TestMachine([factorial_path, str(7)], trace_path=trace_path)
+        run = asyncio.ensure_future(machine.run())
+        factorial_args = [e[1] async for e in machine.events() if e[0] == "test"]
+        await run
+        return machine, factorial_args
+
+    reference = qtrace.TraceMachine([factorial_path, str(7)])
+    reference.run()
+
+    # Events are also read back from a trace file while it is written
+    for trace_path in (None, tmp_path / "trace"):
+        machine, factorial_args = asyncio.run(trace_factorial(trace_path))
+        assert factorial_args == [7, 6, 5, 4, 3, 2, 1, 0]
+        basic_blocks = list(machine.filtered_trace("bb"))
+        assert basic_blocks == list(reference.filtered_trace("bb"))
+
+
+def test_fork_server():
+    factorial_path = programs_dir / "factorial"
+
+    reference = qtrace.TraceMachine([factorial_path, str(7)])
+    reference.run()
+    reference_bbs = list(reference.trace.addresses())
+
+    with qtrace.ForkServer([factorial_path, str(7)]) as server:
+        machines = [server.run() for _ in range(3)]
+
+    main_address = server.binary_base_address + server.address
+    forked_bbs = reference_bbs[reference_bbs.index(main_address) :]
+    for machine in machines:
+        assert machine.process.returncode == 0
+        assert list(machine.trace.addresses()) == forked_bbs
+        output = b"".join(event[2] for event in machine.filtered_trace("output"))
+        assert output == b"factorial(7) = 5040\n"
+
+
+def test_process_memory():
+    factorial_path = programs_dir / "factorial"
+    factorial_address = symbol_address(factorial_path, "factorial")
+
+    class TestMachine(qtrace.TraceMachine):
+        @qtrace.breakpoint(factorial_address)
+        def on_factorial(self):
+            rsp = self.gdb.rsp
+            stack = self.memory[rsp : rsp + 0x100]
+            self.trace.append(("test", stack == self.gdb.fetch_memory(rsp, 0x100)))
+
+    machine = TestMachine([factorial_path, str(3)])
+    machine.run()
+
+    assert [e[1] for e in machine.filtered_trace("test")] == [True] * 4
+
+
+def test_plugin_breakpoints():
+    factorial_path = programs_dir / "factorial"
+    factorial_address = symbol_address(factorial_path, "factorial")
+
+    class TestMachine(qtrace.TraceMachine):
+        @qtrace.breakpoint(factorial_address)
+        def on_factorial(self):
+            rsp = self.registers.rsp
+            stack = self.memory[rsp : rsp + 8]
+            self.trace.append(("test", self.registers.rdi, stack))
+
+    machine = TestMachine([factorial_path, str(7)], plugin_breakpoints=True)
+    machine.run()
+
+    assert machine.gdb is None
+    factorial_args = [e[1] for e in machine.filtered_trace("test")]
+    assert factorial_args == [7, 6, 5, 4, 3, 2, 1, 0]
+    # main's call and the recursive calls each have their own return address
+    stacks = {e[2] for e in machine.filtered_trace("test")}
+    assert len(stacks) == 2
+
+
+def test_plugin_breakpoints_inside_blocks():
+    factorial_path = programs_dir / "factorial"
+    # factorial's first block runs on to its first branch
+    entry_address, inner_address = instruction_addresses(factorial_path, "factorial")[:2]
+
+    class TestMachine(qtrace.TraceMachine):
+        @qtrace.breakpoint(inner_address)
+        def on_factorial(self):
+            # Unlike at a block's start, the block is already traced
+            entry = self.binary_base_address + entry_address
+            assert self.trace[-1] == ("bb", entry)
+            self.trace.append(("test", self.registers.rdi))
+
+    machine = TestMachine([factorial_path, str(7)], plugin_breakpoints=True)
+    machine.run()
+
+    factorial_args = [e[1] for e in machine.filtered_trace("test")]
+    assert factorial_args == [7, 6, 5, 4, 3, 2, 1, 0]
+
+
+def test_breakpoint_conditions():
+    factorial_path = programs_dir / "factorial"
+    factorial_address = symbol_address(factorial_path, "factorial")
+    main_address = symbol_address(factorial_path, "main")
+
+    class TestMachine(qtrace.TraceMachine):
+        @qtrace.breakpoint(main_address, count_only=True)
+        def on_main(self):
+            raise AssertionError("count_only breakpoints are never called")
+
+        @qtrace.breakpoint(factorial_address, every=3, condition=("rdi", "<", 6))
+        def on_factorial(self):
+            # gdb breakpoints have no self.registers
+            self.trace.append(("test", (self.registers or self.gdb).rdi))
+
+    for plugin_breakpoints in (False, True):
+        machine = TestMachine(
+            [factorial_path, str(7)], plugin_breakpoints=plugin_breakpoints
+        )
+        machine.run()
+
+        # Hits 3 and 6 are factorial(5) and factorial(2)
+        assert [e[1] for e in machine.filtered_trace("test")] == [5, 2]
+        assert machine.breakpoint_hits == {"on_main": 1, "on_factorial": 8}
+
+
+def test_syscall_filter():
+    factorial_path = programs_dir / "factorial"
+
+    def syscalls(machine):
+        return [e[:2] for e in machine.trace if e[0].startswith("syscall")]
+
+    reference = qtrace.TraceMachine([factorial_path, str(7)])
+    reference.run()
+
+    # Filtered syscalls are recorded in the stream instead of stopping
+    filtered = qtrace.TraceMachine(
+        [factorial_path, str(7)], syscall_allowlist=["exit_group"]
+    )
+    filtered.run()
+    assert list(filtered.trace.addresses()) == list(reference.trace.addresses())
+    assert syscalls(filtered) == syscalls(reference)
+
+    dropped = qtrace.TraceMachine(
+        [factorial_path, str(7)], syscall_denylist=["write"], drop_filtered_syscalls=True
+    )
+    dropped.run()
+    assert list(dropped.trace.addresses()) == list(reference.trace.addresses())
+    assert syscalls(dropped) == [e for e in syscalls(reference) if e[1] != 1]
+
+
+def test_syscall_records_fill_buffer():
+    syscalls_path = programs_dir / "syscalls"
+
+    class SyncMachine(qtrace.TraceMachine):
+        synchronous_syscalls = True
+
+    def syscalls(machine):
+        return [e[:2] for e in machine.trace if e[0].startswith("syscall")]
+
+    reference = SyncMachine([syscalls_path])
+    reference.run()
+    assert sum(e[1] == 39 for e in syscalls(reference)) == 2 * 0x1000
+
+    # Records of filtered getpid calls end at every position of the plugin's
+    # buffer, including exactly where it is full
+    for rle in (False, True):
+        filtered = SyncMachine([syscalls_path], syscall_denylist=["getpid"], rle=rle)
+        filtered.run()
+        assert list(filtered.trace.addresses()) == list(reference.trace.addresses())
+        assert syscalls(filtered) == syscalls(reference)
+
+
+def test_async_syscalls():
+    factorial_path = programs_dir / "factorial"
+
+    class SyncMachine(qtrace.TraceMachine):
+        synchronous_syscalls = True
+
+    def events(machine):
+        # Output is not ordered with syscalls the target did not stop at
+        return [e[:2] for e in machine.trace if e[0] != "output"]
+
+    sync_machine = SyncMachine([factorial_path, str(7)])
+    sync_machine.run()
+    machine = qtrace.TraceMachine([factorial_path, str(7)])
+    machine.run()
+
+    assert events(machine) == events(sync_machine)
+    assert any(e[0] == "syscall_start" for e in machine.trace)
+
+    # Thousands of syscall records, at every position of the plugin's buffer
+    syscalls_path = programs_dir / "syscalls"
+    sync_machine = SyncMachine([syscalls_path])
+    sync_machine.run()
+    for transport, rle in (("socket", False), ("ring", True)):
+        machine = qtrace.TraceMachine([syscalls_path], transport=transport, rle=rle)
+        machine.run()
+        assert events(machine) == events(sync_machine)
+
+
+def test_syscalls_beyond_table():
+    class RecordingMachine(qtrace.TraceMachine):
+        def on_syscall_start(self, syscall_nr, *args):
+            self.recorded = (syscall_nr, *args)
+
+    # clone3 is newer than the syscall table, so all 6 arguments are kept
+    machine = RecordingMachine(["true"])
+    machine.handle_record(
+        qtrace.machine.TRACE_RECORD.record_syscall_start.value,
+        [435, 1, 2, 3, 4, 5, 6, 7, 8],
+    )
+    assert machine.recorded == (435, 1, 2, 3, 4, 5, 6)
+
+
+def test_breakpoint_address_after_records():
+    TRACE_RECORD = qtrace.machine.TRACE_RECORD
+    RECORD_FLAG = qtrace.encoding.RECORD_FLAG
+
+    class RecordingMachine(qtrace.TraceMachine):
+        def on_basic_block_batch(self, addresses, sequence):
+            self.addresses = list(addresses)
+
+        def on_filtered_syscall(self, event):
+            pass
+
+    # A filtered getpid, then the run [0x10, 0x20] repeated 3 times
+    words = array.array(
+        "Q",
+        [
+            RECORD_FLAG | TRACE_RECORD.record_syscall_end.value << 32 | 2,
+            39,
+            1,
+            RECORD_FLAG | TRACE_RECORD.record_run.value << 32 | 3,
+            3,
+            0x10,
+            0x20,
+        ],
+    )
+    trace_header = qtrace.machine.TraceHeader(
+        qtrace.machine.TRACE_REASON.trace_async.value,
+        qtrace.machine.TRACE_ENCODING.encoding_raw.value,
+        len(words),
+        len(words) * 8,
+        2,
+        0,
+        (0,) * 8,
+    )
+
+    # The address gdb breakpoints add is skipped after the leading records
+    machine = RecordingMachine(["true"], syscall_denylist=["getpid"])
+    machine._skip_breakpoint_trace_address = True
+    machine.handle_trace_payload(trace_header, words.tobytes(), 0)
+    assert machine.addresses == [0x20, 0x10, 0x20, 0x10, 0x20]
+    assert not machine._skip_breakpoint_trace_address
+
+
+def test_fork_server_rejects_breakpoints():
+    class ForkServer:
+        def fork(self, machine):
+            raise AssertionError("Invalid targets are never forked")
+
+    class TestMachine(qtrace.TraceMachine):
+        @qtrace.breakpoint(0x1000)
+        def on_start(self):
+            pass
+
+    machine = TestMachine(["true"], fork_server=ForkServer())
+    with pytest.raises(RuntimeError):
+        machine.setup()
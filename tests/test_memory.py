@@ -0,0 +1,21 @@
+import os
+import ctypes
+
+from qtrace.memory import ProcessMemory
+
+
+def test_process_memory():
+    # This process stands in for QEMU, with its guest at guest_base
+    buffer = ctypes.create_string_buffer(bytes(range(0x100)) * 0x10)
+    guest_base = ctypes.addressof(buffer) - 0x1000
+    memory = ProcessMemory(os.getpid(), guest_base)
+
+    assert memory[0x1000:0x1004] == bytes(range(4))
+    # More regions than fit in one process_vm_readv
+    regions = [(0x1000 + i * 2, 2) for i in range(0x800)]
+    expected = [buffer.raw[i * 2 : i * 2 + 2] for i in range(0x800)]
+    assert memory.read_regions(regions) == expected
+
+    memory[0x1010:0x1014] = b"abcd"
+    assert buffer.raw[0x10:0x14] == b"abcd"
+    memory.close()
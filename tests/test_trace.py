@@ -0,0 +1,56 @@
+import array
+import ctypes
+
+from qtrace.trace import Trace
+
+
+def test_trace_events():
+    events = [
+        ("bb", 0x4000001130),
+        ("syscall_start", 1, 1, 0x4000002000, 6),
+        ("output", 1, b"hello\n"),
+        ("syscall_end", 1, -14),
+        ("test", {"rdi": 7}),
+        ("bb", 0x7FFFF7FD0100),
+    ]
+    trace = Trace(events)
+
+    assert len(trace) == len(events)
+    assert list(trace) == events
+    assert trace == events
+    assert trace[1] == events[1]
+    assert trace[-1] == events[-1]
+    assert trace[2:4] == events[2:4]
+    assert list(trace.filter("bb")) == [events[0], events[-1]]
+    assert list(trace.filter("syscall_end")) == [events[3]]
+    assert list(trace.filter("test")) == [events[4]]
+
+
+def test_trace_basic_blocks():
+    trace = Trace()
+    trace.extend_basic_blocks((ctypes.c_uint64 * 3)(1, 2, 3))
+    trace.extend_basic_blocks(array.array("Q", [4, 5]))
+    trace.extend_basic_blocks([6])
+
+    assert list(trace.addresses()) == [1, 2, 3, 4, 5, 6]
+    assert trace == [("bb", address) for address in range(1, 7)]
+    assert trace.nbytes == 6 * 9
+
+
+def test_trace_indexes():
+    trace = Trace()
+    trace.extend_basic_blocks(array.array("Q", range(0x100)))
+    trace.append(("syscall_start", 60, 0))
+    trace.append(("test", 1))
+    trace.extend_basic_blocks(array.array("Q", range(0x100)))
+    trace.append(("test", 2))
+
+    assert trace.num_events("bb") == 0x200
+    assert trace.num_events("syscall_start") == 1
+    assert trace.num_events("output") == 0
+    assert list(trace.filter("test")) == [("test", 1), ("test", 2)]
+
+    positions = dict(trace.positions)
+    trace.reindex()
+    assert dict(trace.positions) == positions
+    assert trace.num_events("bb") == 0x200
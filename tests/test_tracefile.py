@@ -0,0 +1,81 @@
+import array
+
+import pytest
+
+from qtrace.tracefile import TraceWriter, TraceFile
+
+
+def test_trace_file(tmp_path):
+    trace_path = tmp_path / "trace"
+    events = []
+    with TraceWriter(trace_path, chunk_events=0x100) as writer:
+        for n in range(0x10):
+            addresses = array.array("Q", range(n * 0x40, (n + 1) * 0x40))
+            writer.extend_basic_blocks(addresses)
+            events.extend(("bb", address) for address in addresses)
+            for event in [
+                ("syscall_start", 1, 1, 0x4000002000, 6),
+                ("output", 1, b"hello\n"),
+                ("syscall_end", 1, -14),
+            ]:
+                writer.append(event)
+                events.append(event)
+
+    with TraceFile(trace_path) as trace:
+        assert trace.num_chunks > 1
+        assert len(trace) == len(events)
+        assert list(trace) == events
+        assert trace[0x41] == events[0x41]
+        assert trace[-1] == events[-1]
+        assert trace[0xF0:0x110] == events[0xF0:0x110]
+        assert list(trace.filter("output")) == [("output", 1, b"hello\n")] * 0x10
+        assert trace.num_events("bb") == 0x400
+        assert trace.num_events("syscall_end") == 0x10
+
+
+def test_trace_file_unclosed(tmp_path):
+    trace_path = tmp_path / "trace"
+    writer = TraceWriter(trace_path, chunk_events=0x10)
+    writer.extend(("bb", address) for address in range(0x28))
+    writer.file.flush()
+
+    trace = TraceFile(trace_path)
+    assert list(trace) == [("bb", address) for address in range(0x20)]
+
+
+def test_trace_file_objects(tmp_path):
+    trace_path = tmp_path / "trace"
+    events = [
+        ("test", b"\x00\xff", (1, -2), [None, True], {"key": 1.5}),
+        ("output", 2, b"error\n"),
+        ("test", "text"),
+    ]
+    with TraceWriter(trace_path) as writer:
+        writer.extend(events)
+
+    with TraceFile(trace_path) as trace:
+        assert list(trace) == events
+        assert trace.num_events("test") == 2
+
+    writer = TraceWriter(tmp_path / "unsupported")
+    writer.append(("test", object()))
+    with pytest.raises(TypeError):
+        writer.flush()
+    writer.file.close()
+
+
+def test_trace_writer_read(tmp_path):
+    trace_path = tmp_path / "trace"
+    with TraceWriter(trace_path, chunk_events=0x10) as writer:
+        events = [("bb", address) for address in range(0x18)] + [("test", 1)]
+        writer.extend(events)
+
+        # Written chunks are read back, pending events come from memory
+        assert writer.num_chunks == 1
+        assert len(writer) == len(events)
+        assert list(writer) == events
+        assert writer[0x8] == events[0x8]
+        assert writer[-1] == ("test", 1)
+        assert writer[0xE:0x12] == events[0xE:0x12]
+        assert list(writer.filter("test")) == [("test", 1)]
+        assert writer.num_events("bb") == 0x18
@@ -0,0 +1,34 @@
+import weakref
+import threading
+
+import pytest
+
+from qtrace.utils import thread_inotify, wait_for_path
+
+
+def test_wait_for_path(tmp_path):
+    path = tmp_path / "path"
+    threading.Timer(0.01, path.touch).start()
+    wait_for_path(path, timeout=10)
+    assert path.exists()
+
+    with pytest.raises(TimeoutError):
+        wait_for_path(tmp_path / "missing", timeout=0.01)
+
+
+def test_thread_inotify_closed(tmp_path):
+    fds = []
+    instances = []
+
+    def wait():
+        for _ in range(2):
+            wait_for_path(tmp_path, timeout=0)
+            fds.append(thread_inotify().fd)
+        instances.append(weakref.ref(thread_inotify()))
+
+    # Each thread reuses its inotify instance, which is closed when it exits
+    thread = threading.Thread(target=wait)
+    thread.start()
+    thread.join()
+    assert fds[0] == fds[1]
+    assert instances[0]() is None